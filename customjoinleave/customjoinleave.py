@@ -6,6 +6,7 @@ from __main__ import send_cmd_help
 
 import aiohttp
 import asyncio
+import atexit
 import os
 import os.path
 
@@ -14,6 +15,32 @@ default_settings = {
     "leave_on": False
 }
 
+class WriteBehind:
+    """Saves a JSON file shortly after it is first marked as changed, so that a burst of changes costs one write.
+    Pending changes are also written when the cog is unloaded or the bot exits."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, path: str, data, delay: float=2):
+        self.loop = loop
+        self.path = path
+        self.data = data
+        self.delay = delay
+        self.handle = None
+        atexit.register(self.flush)
+
+    def save(self):
+        if self.handle is None:
+            self.handle = self.loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+            dataIO.save_json(self.path, self.data())
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+
 class Customjoinleave:
     """Play a sound byte."""
     def __init__(self, bot: commands.bot.Bot):
@@ -22,6 +49,10 @@ class Customjoinleave:
         self.sound_base = "data/customjoinleave"
         self.settings_path = "data/customjoinleave/settings.json"
         self.settings = dataIO.load_json(self.settings_path)
+        self.settings_writer = WriteBehind(self.bot.loop, self.settings_path, lambda: self.settings)
+
+    def __unload(self):
+        self.settings_writer.close()
 
     def voice_channel_full(self, voice_channel: discord.Channel) -> bool:
         return voice_channel.user_limit != 0 and len(voice_channel.voice_members) >= voice_channel.user_limit
@@ -87,7 +118,7 @@ class Customjoinleave:
         server = context.message.server
         if server.id not in self.settings:
             self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings_writer.save()
         if context.invoked_subcommand is None:
             await send_cmd_help(context)
 
@@ -104,7 +135,7 @@ class Customjoinleave:
             await self.bot.reply(cf.info("Custom join sounds are now enabled."))
         else:
             await self.bot.reply(cf.info("Custom join sounds are now disabled."))
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings_writer.save()
 
     @_joinleaveset.command(pass_context=True, no_pm=True, name="toggleleave")
     @checks.admin_or_permissions(manage_server=True)
@@ -119,7 +150,7 @@ class Customjoinleave:
             await self.bot.reply(cf.info("Custom leave sounds are now enabled."))
         else:
             await self.bot.reply(cf.info("Custom leave sounds are now disabled."))
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings_writer.save()
 
     @commands.command(pass_context=True, no_pm=True, name="setjoinsound")
     async def _setjoinsound(self, context: commands.context.Context, link: str=None):
@@ -153,7 +184,7 @@ class Customjoinleave:
         server = context.message.server
         if server.id not in self.settings:
             self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings_writer.save()
 
         attach = context.message.attachments
         if len(attach) > 1 or (attach and link):
@@ -226,7 +257,7 @@ class Customjoinleave:
         server = context.message.server
         if server.id not in self.settings:
             self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings_writer.save()
 
         path = "{}/{}".format(self.sound_base, server.id)
         if not os.path.exists(path):
@@ -252,11 +283,11 @@ class Customjoinleave:
 
         if bserver.id not in self.settings:
             self.settings[bserver.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings_writer.save()
 
         if aserver.id not in self.settings:
             self.settings[aserver.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings_writer.save()
 
         if before.voice.voice_channel != after.voice.voice_channel:
             # went from no channel to a channel
@@ -0,0 +1,224 @@
+"""Benchmarks the kz cog against synthetic KZTimer databases.
+
+Run from the root of a Red install with the kz cog installed, e.g.:
+
+    python path/to/kz/benchmark.py --sizes 10000 100000 1000000
+
+For each size, a database with that many playertimes rows is generated and served from a local FTP server, so the
+sync path (download, derived build, incremental merge) is measured along with every query the cog runs.
+"""
+
+import argparse
+import asyncio
+import copy
+import importlib
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import aioftp
+from tabulate import tabulate
+
+async def send_cmd_help(context):
+    pass
+
+jump_types = ["bhop", "lj", "multibhop", "wj", "dropbhop", "ljblock", "ladderjump", "cj"]
+
+maps_per_player = 25
+map_count = 300
+latest_ratio = 10
+changed_ratio = 100
+
+ftp_user = "kz"
+ftp_password = "kz"
+server_id = "benchmark"
+
+class Bot:
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+
+def generate_database(path: str, rows: int, seed: int=0):
+    """Writes a KZTimer database with the given number of playertimes rows."""
+
+    r = random.Random(seed)
+    players = max(rows // maps_per_player, 1)
+    mapnames = ["kz_{}_{}".format(r.choice(["bhop", "climb", "cave", "tower", "ladder", "grotto"]), i) for i in range(map_count)]
+
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode = OFF")
+    con.execute("PRAGMA synchronous = OFF")
+    con.execute("CREATE TABLE playerrank (steamid VARCHAR(32), name VARCHAR(32), country VARCHAR(32), points INT DEFAULT 0, winratio INT DEFAULT 0, pointsratio INT DEFAULT 0, finishedmaps INT DEFAULT 0, multiplier INT DEFAULT 0, finishedmapstp INT DEFAULT 0, finishedmapspro INT DEFAULT 0, lastseen DATE, PRIMARY KEY(steamid));")
+    con.execute("CREATE TABLE playertimes (steamid VARCHAR(32), mapname VARCHAR(32), name VARCHAR(32), teleports INT DEFAULT -1, runtime FLOAT DEFAULT -1.0, runtimepro FLOAT DEFAULT -1.0, teleports_pro INT DEFAULT 0, PRIMARY KEY(steamid, mapname));")
+    con.execute("CREATE TABLE LatestRecords (steamid VARCHAR(32), name VARCHAR(32), runtime FLOAT, teleports INT, map VARCHAR(32), date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);")
+
+    columns = ["steamid VARCHAR(32)"]
+    for j in jump_types:
+        columns += ["{}record FLOAT DEFAULT -1.0".format(j), "{}pre FLOAT DEFAULT -1.0".format(j), "{}max FLOAT DEFAULT -1.0".format(j), "{}strafes INT DEFAULT -1".format(j), "{}sync INT DEFAULT -1".format(j), "{}height FLOAT DEFAULT -1.0".format(j)]
+    columns += ["multibhopcount INT DEFAULT -1", "ljblockdist INT DEFAULT -1", "PRIMARY KEY(steamid)"]
+    con.execute("CREATE TABLE playerjumpstats3 ({});".format(", ".join(columns)))
+
+    count = 0
+    for p in range(players):
+        steamid = "STEAM_1:{}:{}".format(p & 1, p)
+        name = "player{}".format(p)
+        con.execute("INSERT INTO playerrank (steamid, name, country, points) VALUES (?, ?, ?, ?);", (steamid, name, "Unknown", r.randint(0, 100000)))
+
+        times = []
+        latest = []
+        for mapname in r.sample(mapnames, min(maps_per_player, rows - count, map_count)):
+            tp = r.uniform(60, 3600) if r.random() < 0.8 else -1.0
+            pro = r.uniform(90, 5400) if r.random() < 0.5 or tp < 0 else -1.0
+            times.append((steamid, mapname, name, r.randint(1, 200) if tp > 0 else -1, tp, pro, 0))
+            if r.randrange(latest_ratio) == 0:
+                latest.append((steamid, name, tp if tp > 0 else pro, 0 if tp < 0 else times[-1][3], mapname, "-{} minutes".format(r.randint(0, 525600))))
+        con.executemany("INSERT INTO playertimes VALUES (?, ?, ?, ?, ?, ?, ?);", times)
+        con.executemany("INSERT INTO LatestRecords VALUES (?, ?, ?, ?, ?, datetime('now', ?));", latest)
+        count += len(times)
+
+        jumps = [steamid]
+        for j in jump_types:
+            if r.random() < 0.6:
+                jumps += [r.uniform(220, 290), r.uniform(250, 280), r.uniform(280, 310), r.randint(1, 12), r.randint(40, 100), r.uniform(50, 70)]
+            else:
+                jumps += [-1.0, -1.0, -1.0, -1, -1, -1.0]
+        jumps += [r.randint(2, 10), r.randint(220, 260) if r.random() < 0.5 else -1]
+        con.execute("INSERT INTO playerjumpstats3 VALUES ({});".format(", ".join("?" * len(jumps))), jumps)
+
+        if count >= rows:
+            break
+
+    con.commit()
+    con.close()
+
+def change_database(path: str, seed: int=1):
+    """Improves a slice of the times and jumps, as a busy server would between two syncs."""
+
+    r = random.Random(seed)
+    con = sqlite3.connect(path)
+    total = con.execute("SELECT COUNT(*) FROM playertimes;").fetchone()[0]
+    rowids = r.sample(range(1, total + 1), max(total // changed_ratio, 1))
+    con.executemany("UPDATE playertimes SET runtime = runtime * 0.9 WHERE rowid = ? AND runtime > -1.0;", [(i,) for i in rowids])
+    con.executemany("UPDATE playerjumpstats3 SET ljrecord = ljrecord + 1.0 WHERE rowid = ? AND ljrecord > -1.0;", [(i // maps_per_player + 1,) for i in rowids])
+    con.commit()
+    con.close()
+
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 60))
+
+def percentile(samples: list, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+def summarize(name: str, samples: list) -> list:
+    return [name, len(samples), "{:.2f}".format(percentile(samples, 50) * 1000), "{:.2f}".format(percentile(samples, 99) * 1000), "{:.2f}".format(max(samples) * 1000)]
+
+async def measure(make, iterations: int) -> list:
+    samples = []
+    for i in range(iterations):
+        coro = make(i)
+        start = time.perf_counter()
+        await coro
+        samples.append(time.perf_counter() - start)
+    return samples
+
+async def first_page(pages) -> list:
+    try:
+        return await pages.page(0)
+    finally:
+        pages.close()
+
+async def benchmark_size(kz, loop: asyncio.AbstractEventLoop, rows: int, iterations: int, workdir: str) -> list:
+    served = os.path.join(workdir, "ftp-{}".format(rows))
+    os.makedirs(served)
+    source = os.path.join(served, "kztimer-sqlite.sq3")
+
+    start = time.perf_counter()
+    generate_database(source, rows)
+    print("Generated {} rows in {:.1f}s ({:.1f} MiB).".format(rows, time.perf_counter() - start, os.path.getsize(source) / 1024 / 1024))
+
+    ftp = aioftp.Server([aioftp.User(ftp_user, ftp_password, base_path=served)])
+    await ftp.start("127.0.0.1", 0)
+    port = ftp.server.sockets[0].getsockname()[1]
+
+    shutil.rmtree("data/kz/{}".format(server_id), ignore_errors=True)
+    cog = kz.Kz(Bot(loop))
+    cog.settings[server_id] = copy.deepcopy(kz.default_settings)
+    cog.settings[server_id].update(ftp_server="127.0.0.1:{}".format(port), ftp_username=ftp_user, ftp_password=ftp_password, ftp_dbpath="/kztimer-sqlite.sq3", steam_api_key="benchmark")
+
+    results = []
+    try:
+        results.append(summarize("sync: download and full build", await measure(lambda i: cog._update_database(server_id, force=True), 1)))
+        results.append(summarize("sync: unchanged", await measure(lambda i: cog._update_database(server_id, force=True), iterations)))
+        change_database(source)
+        results.append(summarize("sync: download and merge", await measure(lambda i: cog._update_database(server_id, force=True), 1)))
+
+        r = random.Random(2)
+        mapnames = [row["mapname"] for row in await cog._fetchall(server_id, kz.mapnames_query)]
+        steamids = [row["steamid"] for row in await cog._fetchall(server_id, "SELECT steamid FROM playerrank;")]
+        maps = [r.choice(mapnames) for i in range(iterations)]
+        players = [r.choice(steamids) for i in range(iterations)]
+
+        queries = [
+            ("recent", lambda i: cog._fetchall(server_id, kz.recent_query, (10,))),
+            ("jump records", lambda i: cog._fetchall(server_id, kz.jumprecords_query)),
+            ("player jumps", lambda i: cog._fetchone(server_id, kz.player_jumps_query, (players[i],))),
+            ("compared jumps", lambda i: cog._fetchall(server_id, kz.players_jumps_query.format(", ".join("?" * kz.max_compared_players)), tuple(r.sample(steamids, kz.max_compared_players)))),
+            ("player map time", lambda i: cog._fetchone(server_id, kz.player_maptime_query, (players[i], maps[i]))),
+            ("player profile", lambda i: cog._fetchone(server_id, kz.profile_query, (players[i],))),
+            ("player best ranks", lambda i: cog._fetchall(server_id, kz.profile_ranks_query, (players[i], kz.profile_best_ranks))),
+            ("map names", lambda i: cog._fetchall(server_id, kz.mapnames_query)),
+            ("leaders", lambda i: cog._fetchall(server_id, kz.leaders_query, (3,))),
+            ("map index", lambda i: cog._map_index(server_id)),
+            ("maptop all, first page", lambda i: first_page(cog._result_pages(server_id, kz.maptop_queries["all"], (maps[i], maps[i], 100), lambda row: row["overall"], limit=100))),
+        ]
+        for rt in ["all", "tp", "pro"]:
+            params = (lambda i: (maps[i], maps[i], 10)) if rt == "all" else (lambda i: (maps[i], 10))
+            queries.append(("maptop " + rt, lambda i, rt=rt, params=params: cog._fetchall(server_id, kz.maptop_queries[rt], params(i))))
+        for jumptype, query in sorted(kz.jumptop_queries.items()):
+            queries.append(("jumptop " + jumptype, lambda i, query=query: cog._fetchall(server_id, query, (10,))))
+
+        for name, make in queries:
+            results.append(summarize(name, await measure(make, iterations)))
+    finally:
+        cog._Kz__unload()
+        closing = ftp.close()
+        if asyncio.iscoroutine(closing):
+            await closing
+
+    return results
+
+async def main(args: argparse.Namespace, loop: asyncio.AbstractEventLoop):
+    kz = importlib.import_module(args.module)
+
+    workdir = tempfile.mkdtemp(prefix="kz-benchmark-")
+    os.chdir(workdir)
+    os.makedirs("data/kz")
+    kz.check_files()
+
+    try:
+        for rows in args.sizes:
+            results = await benchmark_size(kz, loop, rows, args.iterations, workdir)
+            print(tabulate(results, ["{} rows".format(rows), "Runs", "p50 (ms)", "p99 (ms)", "Max (ms)"], tablefmt="orgtbl"))
+            print()
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print("Kept {}".format(workdir))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the kz cog against synthetic KZTimer databases.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="playertimes rows to generate, one benchmark per size")
+    parser.add_argument("--iterations", type=int, default=200, help="runs per query")
+    parser.add_argument("--module", default="cogs.kz", help="import path of the installed cog")
+    parser.add_argument("--keep", action="store_true", help="keep the generated databases")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(args, loop))
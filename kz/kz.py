@@ -4,24 +4,640 @@ from .utils.dataIO import dataIO
 from .utils import checks, chat_formatting as cf
 from __main__ import send_cmd_help
 
+from typing import Any, Dict, List, Tuple
+
 import aiohttp
 import aioftp
+import asyncio
+import atexit
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import copy
+from difflib import SequenceMatcher
+from functools import partial
+import io
 import json
 import os
+import re
+import shutil
 import sqlite3
 from tabulate import tabulate
+import threading
+import time
+from urllib.request import pathname2url
 
 default_settings = {
     "ftp_server": None,
     "ftp_username": None,
     "ftp_password": None,
     "ftp_dbpath": None,
-    "steam_api_key": None
+    "steam_api_key": None,
+    "sync_ttl": 300,
+    "sync_interval": 300,
+    "incremental_sync": True,
+    "notify_channel": None,
+    "notify_top": 3,
+    "game_servers": {}
+}
+
+default_manifest = {
+    "size": None,
+    "modify": None,
+    "checked": 0,
+    "synced": 0,
+    "sync_duration": None,
+    "last_error": None,
+    "partial": None,
+    "rebuild": None,
+    "derived_from": None
 }
 
+download_attempts = 5
+download_backoff = 2
+
+ftp_timeout = 30
+
+steam_cache_size = 1024
+steam_cache_ttl = 7 * 24 * 60 * 60
+steam_negative_ttl = 10 * 60
+steam_connections = 8
+steam_keepalive = 60
+steam_timeout = 10
+steam_lookup_concurrency = 4
+
+max_compared_players = 10
+
+profile_best_ranks = 5
+
+response_cache_size = 256
+
+map_suggestions = 5
+
+max_announcements = 20
+
+main_server_label = "main"
+
+page_rows = 15
+page_timeout = 120
+page_previous = "\N{BLACK LEFT-POINTING TRIANGLE}"
+page_next = "\N{BLACK RIGHT-POINTING TRIANGLE}"
+
+latency_buckets = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60]
+
+sqlite_cached_statements = 64
+sqlite_cache_kib = 16384
+sqlite_mmap_size = 256 * 1024 * 1024
+
+class WriteBehind:
+    """Saves a JSON file shortly after it is first marked as changed, so that a burst of changes costs one write.
+    Pending changes are also written when the cog is unloaded or the bot exits."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, path: str, data, delay: float=2):
+        self.loop = loop
+        self.path = path
+        self.data = data
+        self.delay = delay
+        self.handle = None
+        atexit.register(self.flush)
+
+    def save(self):
+        if self.handle is None:
+            self.handle = self.loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+            dataIO.save_json(self.path, self.data())
+
+    def close(self):
+        self.flush()
+        atexit.unregister(self.flush)
+
 class SteamUrlError(Exception):
     pass
 
+class SteamApiError(Exception):
+    pass
+
+class SteamIdCache:
+    """An LRU of resolved Steam vanity URLs, backed by a small JSON file. Failed lookups are remembered for a shorter time."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, path: str, size: int=steam_cache_size):
+        self.path = path
+        self.size = size
+        self.entries = OrderedDict()
+        self.writer = WriteBehind(loop, path, lambda: self.entries)
+
+        if dataIO.is_valid_json(self.path):
+            now = time.time()
+            stored = sorted(dataIO.load_json(self.path).items(), key=lambda e: e[1]["expires"])
+            for vanityurl, entry in stored[-self.size:]:
+                if entry["expires"] > now:
+                    self.entries[vanityurl] = entry
+
+    def get(self, vanityurl: str) -> Tuple[bool, str]:
+        key = vanityurl.lower()
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        if entry["expires"] <= time.time():
+            del self.entries[key]
+            return False, None
+
+        self.entries.move_to_end(key)
+        return True, entry["steamid"]
+
+    def put(self, vanityurl: str, steamid: str):
+        key = vanityurl.lower()
+        ttl = steam_cache_ttl if steamid else steam_negative_ttl
+        self.entries[key] = {"steamid": steamid, "expires": time.time() + ttl}
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+        self.writer.save()
+
+    def close(self):
+        self.writer.close()
+
+class MapIndex:
+    """Resolves user input to a canonical map name, using a trigram index over the names in a snapshot."""
+
+    def __init__(self, mapnames: List[str]):
+        self.canonical = {m.lower(): m for m in mapnames}
+        self.trigrams = defaultdict(set)
+
+        for name in self.canonical:
+            for t in self._trigrams(name):
+                self.trigrams[t].add(name)
+
+    def _trigrams(self, text: str) -> set:
+        padded = "  {} ".format(text)
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def _closest(self, query: str, names) -> List[str]:
+        query_trigrams = self._trigrams(query)
+        scored = []
+        for name in names:
+            name_trigrams = self._trigrams(name)
+            score = len(query_trigrams & name_trigrams) / len(query_trigrams | name_trigrams)
+            scored.append((-score, -SequenceMatcher(None, query, name).ratio(), len(name), name))
+        return [self.canonical[n] for _, _, _, n in sorted(scored)[:map_suggestions]]
+
+    def resolve(self, query: str) -> Tuple[str, List[str]]:
+        """Returns the canonical map name, or None and the closest map names if the query is unknown or ambiguous."""
+
+        q = query.strip().lower()
+        if q in self.canonical:
+            return self.canonical[q], []
+
+        candidates = None
+        if len(q) >= 3:
+            for t in {q[i:i + 3] for i in range(len(q) - 2)}:
+                candidates = self.trigrams.get(t, set()) if candidates is None else candidates & self.trigrams.get(t, set())
+        else:
+            candidates = self.canonical.keys()
+        matches = [n for n in candidates if q in n]
+
+        if len(matches) == 1:
+            return self.canonical[matches[0]], []
+
+        unprefixed = [n for n in matches if n.split("_", 1)[-1] == q]
+        if len(unprefixed) == 1:
+            return self.canonical[unprefixed[0]], []
+
+        if matches:
+            return None, self._closest(q, matches)
+
+        # The padded trigrams at the start of the query only match names with the same prefix, so they are left out here.
+        candidates = set()
+        for t in {q[i:i + 3] for i in range(len(q) - 2)}:
+            candidates |= self.trigrams.get(t, set())
+        if len(candidates) < map_suggestions:
+            candidates = self.canonical.keys()
+        return None, self._closest(q, candidates)
+
+class ResponseCache:
+    """An LRU of rendered command responses. Entries are tagged with the versions of the snapshots they were rendered from, as (snapshot, version) pairs."""
+
+    def __init__(self, size: int=response_cache_size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key: Tuple, version: Any) -> str:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: Tuple, version: Any, response: str):
+        self.entries[key] = (version, response)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, server_id: str):
+        for key in [k for k in self.entries if k[0] == server_id]:
+            del self.entries[key]
+
+    def retag(self, server_id: str, db_id: str, old_version: Any, new_version: Any, stale):
+        for key in [k for k in self.entries if k[0] == server_id]:
+            version, response = self.entries[key]
+            if (db_id, old_version) in version and not stale(key):
+                self.entries[key] = (tuple((d, new_version if d == db_id else v) for d, v in version), response)
+            else:
+                del self.entries[key]
+
+class LatencyStats:
+    """In-process latency histograms, one per span name. While a command is being traced, its spans are also
+    counted under "<command> <span>", so a slow command can be broken down into where its time went."""
+
+    def __init__(self, buckets: List[float]=latency_buckets):
+        self.buckets = buckets
+        self.histograms = {}
+        self.traces = {}
+        self.starts = {}
+        self.lock = threading.Lock()
+
+    def _current_task(self) -> asyncio.Task:
+        current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+        try:
+            return current_task()
+        except RuntimeError:
+            return None
+
+    def begin(self, command: str):
+        """Traces the current task as the given command until it finishes."""
+
+        task = self._current_task()
+        if task is None or task in self.traces:
+            return
+
+        self.traces[task] = command
+        self.starts[task] = time.perf_counter()
+        task.add_done_callback(self._finish)
+
+    def end(self):
+        """Records the total for the current task's command now, for commands that keep running after they have answered."""
+
+        start = self.starts.pop(self._current_task(), None)
+        if start is not None:
+            self.record("total", time.perf_counter() - start)
+
+    def _finish(self, task: asyncio.Task):
+        start = self.starts.pop(task, None)
+        command = self.traces.pop(task, None)
+        if start is not None:
+            self.record("total", time.perf_counter() - start, command)
+
+    def record(self, span: str, seconds: float, command: str=None):
+        if command is None:
+            command = self.traces.get(self._current_task())
+
+        names = [span] if command is None else [span, "{} {}".format(command, span)]
+        with self.lock:
+            for name in names:
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = {"counts": [0] * (len(self.buckets) + 1), "count": 0, "sum": 0.0, "max": 0.0}
+                i = 0
+                while i < len(self.buckets) and seconds > self.buckets[i]:
+                    i += 1
+                histogram["counts"][i] += 1
+                histogram["count"] += 1
+                histogram["sum"] += seconds
+                histogram["max"] = max(histogram["max"], seconds)
+
+    def gather(self, *coros, **kwargs) -> asyncio.Future:
+        """Like asyncio.gather, but the gathered coroutines are traced under the calling task's command."""
+
+        command = self.traces.get(self._current_task())
+        if command is None:
+            return asyncio.gather(*coros, **kwargs)
+        return asyncio.gather(*[self._traced(command, c) for c in coros], **kwargs)
+
+    async def _traced(self, command: str, coro):
+        task = self._current_task()
+        self.traces[task] = command
+        try:
+            return await coro
+        finally:
+            self.traces.pop(task, None)
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def percentile(self, name: str, p: float) -> float:
+        """Returns the upper bound of the bucket holding the p-th percentile, or the maximum for the last bucket."""
+
+        histogram = self.histograms[name]
+        rank = p / 100 * histogram["count"]
+        seen = 0
+        for i, count in enumerate(histogram["counts"]):
+            seen += count
+            if seen >= rank and count:
+                return min(self.buckets[i], histogram["max"]) if i < len(self.buckets) else histogram["max"]
+        return histogram["max"]
+
+    def export(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"buckets": self.buckets, "spans": copy.deepcopy(self.histograms)}
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+
+class FtpPool:
+    """A small per-server pool of logged-in FTP clients, so that syncs share one session. Idle sessions are kept
+    alive with NOOPs until a little past the next sync, and closed after that."""
+
+    def __init__(self, size: int=2, keepalive: int=30, idle_margin: int=60):
+        self.size = size
+        self.keepalive = keepalive
+        self.idle_margin = idle_margin
+        self.idle = defaultdict(list)
+        self.slots = defaultdict(lambda: asyncio.Semaphore(self.size))
+
+    def connection(self, server_id: str, info: Dict[str, Any]) -> "FtpConnection":
+        return FtpConnection(self, server_id, (info["ftp_server"], info["ftp_username"], info["ftp_password"]), info["sync_interval"] + self.idle_margin)
+
+    async def _ping(self, client: aioftp.Client) -> bool:
+        try:
+            await asyncio.wait_for(client.command("NOOP", "2xx"), ftp_timeout)
+            return True
+        except (OSError, asyncio.TimeoutError, aioftp.StatusCodeError):
+            client.close()
+            return False
+
+    async def acquire(self, server_id: str, credentials: Tuple[str, str, str]) -> aioftp.Client:
+        idle = self.idle[server_id]
+
+        while idle:
+            entry = idle.pop()
+            now = time.time()
+            if entry["credentials"] != credentials or now - entry["released"] > entry["idle_timeout"]:
+                entry["client"].close()
+                continue
+            if now - entry["pinged"] > self.keepalive and not await self._ping(entry["client"]):
+                continue
+            return entry["client"]
+
+        host, username, password = credentials
+        host, _, port = host.partition(":")
+        # Without timeouts a server that stops responding mid-transfer hangs the sync, and every caller waiting on it.
+        client = aioftp.Client(socket_timeout=ftp_timeout, connection_timeout=ftp_timeout)
+        await client.connect(host, int(port or 21))
+        await client.login(username, password)
+        return client
+
+    def release(self, server_id: str, client: aioftp.Client, credentials: Tuple[str, str, str], idle_timeout: int, broken: bool=False):
+        if broken or len(self.idle[server_id]) >= self.size:
+            client.close()
+        else:
+            now = time.time()
+            self.idle[server_id].append({"client": client, "credentials": credentials, "released": now, "pinged": now, "idle_timeout": idle_timeout})
+
+    async def maintain(self):
+        """Closes sessions that have been idle for too long, and sends a NOOP on the others so the server keeps them open."""
+
+        for server_id, idle in list(self.idle.items()):
+            for entry in list(idle):
+                # acquire can take entries while a NOOP is awaited below.
+                if entry not in idle:
+                    continue
+                now = time.time()
+                if now - entry["released"] > entry["idle_timeout"]:
+                    idle.remove(entry)
+                    entry["client"].close()
+                elif now - entry["pinged"] >= self.keepalive:
+                    # Taken out of the pool while pinging, so that acquire cannot hand it out at the same time.
+                    idle.remove(entry)
+                    if await self._ping(entry["client"]):
+                        entry["pinged"] = time.time()
+                        if len(idle) < self.size:
+                            idle.append(entry)
+                        else:
+                            entry["client"].close()
+
+    async def maintain_forever(self):
+        while True:
+            await asyncio.sleep(self.keepalive)
+            try:
+                await self.maintain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                print("FTP pool maintenance failed: {!r}".format(err))
+
+    def close(self):
+        for idle in self.idle.values():
+            for entry in idle:
+                entry["client"].close()
+            idle.clear()
+
+class FtpConnection:
+    def __init__(self, pool: FtpPool, server_id: str, credentials: Tuple[str, str, str], idle_timeout: int):
+        self.pool = pool
+        self.server_id = server_id
+        self.credentials = credentials
+        self.idle_timeout = idle_timeout
+        self.client = None
+
+    async def __aenter__(self) -> aioftp.Client:
+        await self.pool.slots[self.server_id].acquire()
+        try:
+            self.client = await self.pool.acquire(self.server_id, self.credentials)
+        except:
+            self.pool.slots[self.server_id].release()
+            raise
+        return self.client
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pool.release(self.server_id, self.client, self.credentials, self.idle_timeout, broken=exc_type is not None)
+        self.pool.slots[self.server_id].release()
+
+class QueryExecutor:
+    """Runs SQLite queries on a bounded thread pool, keeping one read-only connection per worker thread and database.
+    Snapshots never change in place, so connections are opened immutable and only reopened when the version changes."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, workers: int=4, latency: LatencyStats=None):
+        self.loop = loop
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+        self.latency = latency
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def _connection(self, path: str, version: Any) -> sqlite3.Connection:
+        if not hasattr(self.local, "connections"):
+            self.local.connections = {}
+        connections = self.local.connections
+
+        if path in connections:
+            con_version, con = connections[path]
+            if con_version == version:
+                return con
+            con.close()
+
+        con = self._connect(path)
+        connections[path] = (version, con)
+        return con
+
+    def _connect(self, path: str, shared: bool=False) -> sqlite3.Connection:
+        uri = "file:{}?mode=ro&immutable=1".format(pathname2url(os.path.abspath(path)))
+        con = sqlite3.connect(uri, uri=True, cached_statements=sqlite_cached_statements, check_same_thread=not shared)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA cache_size = -{}".format(sqlite_cache_kib))
+        con.execute("PRAGMA mmap_size = {}".format(sqlite_mmap_size))
+        return con
+
+    def _run(self, path: str, version: Any, query: str, params: Tuple, one: bool):
+        cur = self._connection(path, version).execute(query, params)
+        try:
+            return cur.fetchone() if one else cur.fetchall()
+        finally:
+            cur.close()
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        return result, time.perf_counter() - start
+
+    async def _submit(self, fn, *args):
+        result, elapsed = await self.loop.run_in_executor(self.pool, self._timed, fn, *args)
+        if self.latency is not None:
+            self.latency.record("sql", elapsed)
+        return result
+
+    async def fetchone(self, path: str, version: Any, query: str, params: Tuple=()) -> sqlite3.Row:
+        return await self._submit(self._run, path, version, query, params, True)
+
+    async def fetchall(self, path: str, version: Any, query: str, params: Tuple=()) -> List[sqlite3.Row]:
+        return await self._submit(self._run, path, version, query, params, False)
+
+    def _open_cursor(self, path: str, version: Any, query: str, params: Tuple) -> sqlite3.Cursor:
+        con = None
+        with self.lock:
+            stream = self.streams.get(path)
+            if stream is None or stream[0] != version:
+                if stream is not None:
+                    for c in stream[1]:
+                        c.close()
+                stream = self.streams[path] = (version, [])
+            if stream[1]:
+                con = stream[1].pop()
+
+        if con is None:
+            con = self._connect(path, shared=True)
+        return con.execute(query, params)
+
+    async def cursor(self, path: str, version: Any, query: str, params: Tuple=()) -> sqlite3.Cursor:
+        """Opens a cursor that can be read in batches from any worker thread. Each cursor has a connection to itself
+        until it is released, and released connections are kept for later cursors on the same version."""
+
+        return await self._submit(self._open_cursor, path, version, query, params)
+
+    def release(self, path: str, version: Any, cursor: sqlite3.Cursor):
+        con = cursor.connection
+        cursor.close()
+        with self.lock:
+            stream = self.streams.get(path)
+            if stream is not None and stream[0] == version and len(stream[1]) < self.workers:
+                stream[1].append(con)
+                return
+        con.close()
+
+    async def fetchmany(self, cursor: sqlite3.Cursor, size: int) -> List[sqlite3.Row]:
+        return await self._submit(cursor.fetchmany, size)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        with self.lock:
+            for version, connections in self.streams.values():
+                for con in connections:
+                    con.close()
+            self.streams.clear()
+
+class ResultPages:
+    """Streams the sorted results of a query over one or more snapshots in pages, merging them on the given key.
+    Rows are fetched in page-sized batches as pages are requested, and pages already seen are kept."""
+
+    def __init__(self, queries: QueryExecutor, sources: List[Tuple[str, str, Any]], query: str, params: Tuple, key, reverse: bool=False, limit: int=None, size: int=page_rows, gather=asyncio.gather):
+        self.queries = queries
+        self.gather = gather
+        self.sources = sources
+        self.query = query
+        self.params = params
+        self.key = key
+        self.reverse = reverse
+        self.limit = limit
+        self.size = size
+        self.cursors = None
+        self.buffers = [deque() for s in sources]
+        self.exhausted = [False for s in sources]
+        self.pages = []
+        self.count = 0
+        self.done = False
+
+    async def _fill(self):
+        empty = [i for i, b in enumerate(self.buffers) if not b and not self.exhausted[i]]
+        if not empty:
+            return
+
+        batches = await self.gather(*[self.queries.fetchmany(self.cursors[i], self.size) for i in empty])
+        for i, rows in zip(empty, batches):
+            self.buffers[i].extend(rows)
+            if len(rows) < self.size:
+                self.exhausted[i] = True
+                self.queries.release(self.sources[i][1], self.sources[i][2], self.cursors[i])
+
+    async def page(self, n: int) -> List[Tuple[str, sqlite3.Row]]:
+        """Returns the rows on page n as (label, row) pairs, or None if there are fewer pages."""
+
+        if self.cursors is None:
+            self.cursors = await self.gather(*[self.queries.cursor(path, version, self.query, self.params) for label, path, version in self.sources])
+
+        pick = max if self.reverse else min
+
+        while len(self.pages) <= n and not self.done:
+            rows = []
+            while len(rows) < self.size and (self.limit is None or self.count < self.limit):
+                await self._fill()
+                heads = [i for i, b in enumerate(self.buffers) if b]
+                if not heads:
+                    break
+                i = pick(heads, key=lambda i: self.key(self.buffers[i][0]))
+                rows.append((self.sources[i][0], self.buffers[i].popleft()))
+                self.count += 1
+
+            if rows:
+                self.pages.append(rows)
+
+            await self._fill()
+            if not rows or (self.limit is not None and self.count >= self.limit) or not any(self.buffers):
+                self.done = True
+                self.close()
+
+        return self.pages[n] if n < len(self.pages) else None
+
+    def close(self):
+        for i, cursor in enumerate(self.cursors or []):
+            if not self.exhausted[i]:
+                self.exhausted[i] = True
+                self.queries.release(self.sources[i][1], self.sources[i][2], cursor)
+
 class Kz:
     """Gets KZ stats from a server. Use [p]kzset to set parameters."""
 
@@ -29,6 +645,40 @@ class Kz:
         self.bot = bot
         self.settings_path = "data/kz/settings.json"
         self.settings = dataIO.load_json(self.settings_path)
+        self.settings_writer = WriteBehind(self.bot.loop, self.settings_path, lambda: self.settings)
+        self.manifests = {}
+        self.refreshers = {}
+        self.syncs = {}
+        self.records = {}
+        self.map_indexes = {}
+        self.combined_map_indexes = {}
+        self.leaders = {}
+        self.responses = ResponseCache()
+        self.latency = LatencyStats()
+        self.queries = QueryExecutor(self.bot.loop, latency=self.latency)
+        self.steam_ids = SteamIdCache(self.bot.loop, "data/kz/steamids.json")
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=steam_connections, use_dns_cache=True, keepalive_timeout=steam_keepalive, loop=self.bot.loop), loop=self.bot.loop)
+        self.ftp_pool = FtpPool()
+        self.ftp_maintainer = self.bot.loop.create_task(self.ftp_pool.maintain_forever())
+
+        for server_id, server_settings in self.settings.items():
+            for k, v in default_settings.items():
+                server_settings.setdefault(k, copy.deepcopy(v))
+            for db_id in self._db_ids(server_id):
+                self._start_refresher(db_id)
+
+    def __unload(self):
+        for task in self.refreshers.values():
+            task.cancel()
+        self.ftp_maintainer.cancel()
+        self.ftp_pool.close()
+        self.queries.close()
+        self.steam_ids.close()
+        self.settings_writer.close()
+
+        closing = self.http.close()
+        if asyncio.iscoroutine(closing):
+            self.bot.loop.create_task(closing)
 
     @commands.group(pass_context=True, no_pm=True, name="kzset")
     @checks.admin_or_permissions(manage_server=True)
@@ -37,19 +687,21 @@ class Kz:
 
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings_writer.save()
             os.makedirs("data/kz/{}".format(server.id))
         if context.invoked_subcommand is None:
             await send_cmd_help(context)
 
     @_kzset.command(pass_context=True, no_pm=True, name="server")
     async def _server(self, context: commands.context.Context, server: str):
-        """Set the FTP server."""
+        """Set the FTP server. A port other than 21 can be given as host:port."""
 
         serv = context.message.server
         self.settings[serv.id]["ftp_server"] = server
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings_writer.save()
+        self._invalidate_manifest(serv.id)
+        self._start_refresher(serv.id)
         await self.bot.reply(cf.info("Server set."))
 
     @_kzset.command(pass_context=True, no_pm=True, name="username")
@@ -58,7 +710,8 @@ class Kz:
 
         server = context.message.server
         self.settings[server.id]["ftp_username"] = username
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings_writer.save()
+        self._start_refresher(server.id)
         await self.bot.reply(cf.info("Username set."))
 
     @_kzset.command(pass_context=True, no_pm=True, name="password")
@@ -70,7 +723,8 @@ class Kz:
         await self.bot.delete_message(context.message)
         
         self.settings[server.id]["ftp_password"] = password
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings_writer.save()
+        self._start_refresher(server.id)
 
         await self.bot.reply(cf.info("Password set."))
 
@@ -80,9 +734,63 @@ class Kz:
 
         server = context.message.server
         self.settings[server.id]["ftp_dbpath"] = dbpath
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings_writer.save()
+        self._invalidate_manifest(server.id)
+        self._start_refresher(server.id)
         await self.bot.reply(cf.info("Path to database set."))
 
+    @_kzset.command(pass_context=True, no_pm=True, name="addserver")
+    async def _addserver(self, context: commands.context.Context, name: str, server: str, username: str, password: str, dbpath: str):
+        """Adds another game server whose database is searched alongside the main one."""
+
+        serv = context.message.server
+
+        await self.bot.delete_message(context.message)
+
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name) or name.lower() == main_server_label:
+            await self.bot.reply(cf.error("The name may only contain letters, digits, `-` and `_`, and cannot be `{}`.".format(main_server_label)))
+            return
+
+        self.settings[serv.id]["game_servers"][name] = {"ftp_server": server, "ftp_username": username, "ftp_password": password, "ftp_dbpath": dbpath}
+        self.settings_writer.save()
+
+        db_id = "{}/{}".format(serv.id, name)
+        self._invalidate_manifest(db_id)
+        self.responses.invalidate(serv.id)
+        self._start_refresher(db_id, restart=True)
+
+        await self.bot.reply(cf.info("Game server `{}` added.".format(name)))
+
+    @_kzset.command(pass_context=True, no_pm=True, name="removeserver")
+    async def _removeserver(self, context: commands.context.Context, name: str):
+        """Removes a game server added with addserver."""
+
+        server = context.message.server
+
+        if name not in self.settings[server.id]["game_servers"]:
+            await self.bot.reply(cf.error("There is no game server named `{}`.".format(name)))
+            return
+
+        db_id = "{}/{}".format(server.id, name)
+        task = self.refreshers.pop(db_id, None)
+        if task:
+            task.cancel()
+        # A running sync would otherwise keep writing into the directory removed below.
+        sync = self.syncs.pop(db_id, None)
+        if sync:
+            sync.cancel()
+            await asyncio.wait([sync])
+
+        del self.settings[server.id]["game_servers"][name]
+        self.settings_writer.save()
+
+        for cache in (self.manifests, self.records, self.map_indexes, self.leaders):
+            cache.pop(db_id, None)
+        self.responses.invalidate(server.id)
+        shutil.rmtree(os.path.dirname(self._database_path(db_id)), ignore_errors=True)
+
+        await self.bot.reply(cf.info("Game server `{}` removed.".format(name)))
+
     @_kzset.command(pass_context=True, no_pm=True, name="steamkey")
     async def _steamkey(self, context: commands.context.Context, steamkey: str):
         """Sets the Steam API key."""
@@ -92,36 +800,543 @@ class Kz:
         await self.bot.delete_message(context.message)
 
         self.settings[server.id]["steam_api_key"] = steamkey
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings_writer.save()
+        self._start_refresher(server.id)
 
         await self.bot.reply(cf.info("Steam API key set."))
 
-    def _check_settings(self, server_id: str) -> bool:
-        server_settings = self.settings[server_id]
-        return server_settings["ftp_server"] and server_settings["ftp_username"] and server_settings["ftp_password"] and server_settings["ftp_dbpath"] and server_settings["steam_api_key"]
+    @_kzset.command(pass_context=True, no_pm=True, name="ttl")
+    async def _ttl(self, context: commands.context.Context, seconds: str):
+        """Sets how long, in seconds, the local copy of the database is trusted before the server is checked for changes again."""
+
+        server = context.message.server
+
+        ttl = None
+        try:
+            ttl = int(seconds)
+        except ValueError:
+            await self.bot.reply(cf.error("The TTL you provided is not a number."))
+            return
+
+        if ttl < 0:
+            await self.bot.reply(cf.error("The TTL cannot be negative."))
+            return
+
+        self.settings[server.id]["sync_ttl"] = ttl
+        self.settings_writer.save()
+
+        await self.bot.reply(cf.info("Database TTL set to {} seconds.".format(ttl)))
+
+    @_kzset.command(pass_context=True, no_pm=True, name="interval")
+    async def _interval(self, context: commands.context.Context, seconds: str):
+        """Sets how often, in seconds, the database is refreshed in the background."""
+
+        server = context.message.server
+
+        interval = None
+        try:
+            interval = int(seconds)
+        except ValueError:
+            await self.bot.reply(cf.error("The interval you provided is not a number."))
+            return
+
+        if interval < 30:
+            await self.bot.reply(cf.error("The interval must be at least 30 seconds."))
+            return
+
+        self.settings[server.id]["sync_interval"] = interval
+        self.settings_writer.save()
+        self._start_refresher(server.id, restart=True)
+
+        await self.bot.reply(cf.info("Refresh interval set to {} seconds.".format(interval)))
+
+    @_kzset.command(pass_context=True, no_pm=True, name="incremental")
+    async def _incremental(self, context: commands.context.Context):
+        """Toggles merging only changed rows into the local database, instead of rebuilding it from every download."""
+
+        server = context.message.server
+        self.settings[server.id]["incremental_sync"] = not self.settings[server.id]["incremental_sync"]
+        self.settings_writer.save()
+
+        if self.settings[server.id]["incremental_sync"]:
+            await self.bot.reply(cf.info("New downloads will now be merged into the local database."))
+        else:
+            await self.bot.reply(cf.info("The local database will now be rebuilt from every download."))
+
+    @_kzset.command(pass_context=True, no_pm=True, name="notify")
+    async def _notify(self, context: commands.context.Context, channel: discord.Channel=None):
+        """Sets the text channel in which new top times and jump records are announced. If none is specified, announcements are turned off."""
+
+        server = context.message.server
+
+        self.settings[server.id]["notify_channel"] = channel.id if channel else None
+        self.settings_writer.save()
+        for db_id in self._db_ids(server.id):
+            self.leaders.pop(db_id, None)
+
+        if channel:
+            await self.bot.reply(cf.info("New records will be announced in {}. Announcements start after the next database sync.".format(channel.mention)))
+        else:
+            await self.bot.reply(cf.info("New records will no longer be announced."))
+
+    @_kzset.command(pass_context=True, no_pm=True, name="notifytop")
+    async def _notifytop(self, context: commands.context.Context, top: str):
+        """Sets how many of the top times on each map are watched for announcements."""
+
+        server = context.message.server
+
+        n = None
+        try:
+            n = int(top)
+        except ValueError:
+            await self.bot.reply(cf.error("The number you provided is not a number."))
+            return
+
+        if n < 1:
+            await self.bot.reply(cf.error("The number must be at least 1."))
+            return
+
+        self.settings[server.id]["notify_top"] = n
+        self.settings_writer.save()
+        for db_id in self._db_ids(server.id):
+            self.leaders.pop(db_id, None)
+
+        await self.bot.reply(cf.info("The top {} time{} on each map will be watched.".format(n, "" if n == 1 else "s")))
+
+    @_kzset.command(pass_context=True, no_pm=True, name="status")
+    async def _status(self, context: commands.context.Context):
+        """Shows the state of the local database snapshot."""
+
+        server = context.message.server
+        db_ids = self._db_ids(server.id)
+        now = time.time()
+
+        lines = []
+        for db_id in db_ids:
+            manifest = self._get_manifest(db_id)
+            indent = ""
+            if len(db_ids) > 1:
+                info = self._db_info(db_id)
+                lines.append("[{}] {}:{}".format(self._db_label(db_id), info["ftp_server"], info["ftp_dbpath"]))
+                indent = "  "
+
+            if os.path.exists(self._derived_path(db_id)) and manifest["synced"]:
+                lines.append(indent + "Snapshot age: {}".format(self._seconds_to_time_string(now - manifest["synced"])))
+            else:
+                lines.append(indent + "Snapshot age: no snapshot yet")
+            if manifest["checked"]:
+                lines.append(indent + "Last checked: {} ago".format(self._seconds_to_time_string(now - manifest["checked"])))
+            if manifest["sync_duration"] is not None:
+                lines.append(indent + "Last sync took: {:.2f}s".format(manifest["sync_duration"]))
+            if manifest["rebuild"]:
+                lines.append(indent + "Last rebuild: {}".format(manifest["rebuild"]))
+            lines.append(indent + "Background refresh: {}".format("running" if db_id in self.refreshers and not self.refreshers[db_id].done() else "stopped"))
+            if manifest["last_error"]:
+                lines.append(indent + "Last error: {}".format(manifest["last_error"]))
+
+        lines.append("Refresh interval: {}s, TTL: {}s".format(self.settings[server.id]["sync_interval"], self.settings[server.id]["sync_ttl"]))
+
+        await self.bot.say(cf.box("\n".join(lines)))
+
+    @_kzset.command(pass_context=True, no_pm=True, name="stats")
+    async def _stats(self, context: commands.context.Context, action: str=None):
+        """Shows how long commands spend in the Steam API, database syncs, SQLite, rendering, sending and flipping pages. Use `json` to export the histograms, or `reset` to clear them."""
+
+        if action == "reset":
+            self.latency.reset()
+            await self.bot.reply(cf.info("Latency stats reset."))
+            return
+
+        if action == "json":
+            export = json.dumps(self.latency.export(), indent=4, sort_keys=True)
+            await self.bot.upload(io.BytesIO(export.encode("utf-8")), filename="kz-latency.json")
+            return
 
-    async def _update_database(self, server_id: str):
+        if action is not None:
+            await self.bot.reply(cf.error("The action must be `json` or `reset`."))
+            return
+
+        if not self.latency.histograms:
+            await self.bot.reply(cf.info("Nothing has been measured yet."))
+            return
+
+        headers = ["Span", "Count", "p50 (ms)", "p99 (ms)", "Max (ms)"]
+        rows = []
+        for name, histogram in sorted(self.latency.histograms.items()):
+            rows.append([name, histogram["count"], round(self.latency.percentile(name, 50) * 1000, 1), round(self.latency.percentile(name, 99) * 1000, 1), round(histogram["max"] * 1000, 1)])
+
+        for page in cf.pagify(tabulate(rows, headers, tablefmt="orgtbl"), shorten_by=16):
+            await self.bot.say(cf.box(page))
+
+    def _check_settings(self, db_id: str) -> bool:
+        info = self._db_info(db_id)
+        return info["ftp_server"] and info["ftp_username"] and info["ftp_password"] and info["ftp_dbpath"] and info["steam_api_key"]
+
+    def _db_ids(self, server_id: str) -> List[str]:
+        return [server_id] + ["{}/{}".format(server_id, name) for name in sorted(self.settings[server_id]["game_servers"])]
+
+    def _db_exists(self, db_id: str) -> bool:
+        server_id, _, name = db_id.partition("/")
+        return server_id in self.settings and (not name or name in self.settings[server_id]["game_servers"])
+
+    def _db_info(self, db_id: str) -> Dict[str, Any]:
+        server_id, _, name = db_id.partition("/")
         info = self.settings[server_id]
+        if name:
+            info = dict(info, **info["game_servers"][name])
+        return info
+
+    def _db_label(self, db_id: str) -> str:
+        return db_id.partition("/")[2] or main_server_label
 
-        ftp = aioftp.Client()
-        await ftp.connect(info["ftp_server"])
-        await ftp.login(info["ftp_username"], info["ftp_password"])
+    def _snapshot_ids(self, server_id: str) -> List[str]:
+        return [d for d in self._db_ids(server_id) if os.path.exists(self._derived_path(d))]
 
-        await ftp.download(info["ftp_dbpath"], "data/kz/{}/kztimer-sqlite.sq3".format(server_id), write_into=True)
+    def _snapshot_version(self, server_id: str) -> Tuple:
+        return tuple((d, self._get_manifest(d)["synced"]) for d in self._db_ids(server_id))
 
-        await ftp.quit()
+    def _database_path(self, db_id: str) -> str:
+        return "data/kz/{}/kztimer-sqlite.sq3".format(db_id)
+
+    def _derived_path(self, db_id: str) -> str:
+        return "data/kz/{}/kztimer-derived.sq3".format(db_id)
+
+    def _manifest_path(self, db_id: str) -> str:
+        return "data/kz/{}/manifest.json".format(db_id)
+
+    def _get_manifest(self, db_id: str) -> Dict[str, Any]:
+        if db_id not in self.manifests:
+            manifest = dict(default_manifest)
+            if dataIO.is_valid_json(self._manifest_path(db_id)):
+                manifest.update(dataIO.load_json(self._manifest_path(db_id)))
+            self.manifests[db_id] = manifest
+        return self.manifests[db_id]
+
+    def _save_manifest(self, db_id: str):
+        dataIO.save_json(self._manifest_path(db_id), self._get_manifest(db_id))
+
+    def _invalidate_manifest(self, db_id: str):
+        manifest = self._get_manifest(db_id)
+        manifest.update(default_manifest)
+        if os.path.exists(os.path.dirname(self._manifest_path(db_id))):
+            self._save_manifest(db_id)
+
+    def _database_is_current(self, db_id: str, remote: Dict[str, str]) -> bool:
+        manifest = self._get_manifest(db_id)
+        db_path = self._database_path(db_id)
+
+        if not os.path.exists(db_path):
+            return False
+        if remote["size"] is not None and str(os.path.getsize(db_path)) != remote["size"]:
+            return False
+        return remote["size"] == manifest["size"] and remote["modify"] == manifest["modify"]
+
+    async def _remote_file_info(self, ftp: aioftp.Client, path: str) -> Dict[str, str]:
+        try:
+            info = await ftp.stat(path)
+            if info.get("size") and info.get("modify"):
+                return {"size": info["size"], "modify": info["modify"]}
+        except aioftp.StatusCodeError:
+            pass
+
+        code, size = await ftp.command("SIZE " + path, "213")
+        code, modify = await ftp.command("MDTM " + path, "213")
+        return {"size": size[0].strip(), "modify": modify[0].strip()}
+
+    def _database_is_stale(self, db_id: str) -> bool:
+        return time.time() - self._get_manifest(db_id)["checked"] >= self._db_info(db_id)["sync_ttl"]
+
+    async def _download_database(self, db_id: str, remote: Dict[str, str]):
+        info = self._db_info(db_id)
+        manifest = self._get_manifest(db_id)
+        tmp_path = self._database_path(db_id) + ".tmp"
+        size = int(remote["size"])
+
+        if manifest["partial"] != remote["modify"] and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        manifest["partial"] = remote["modify"]
+        self._save_manifest(db_id)
+
+        for attempt in range(download_attempts):
+            offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+            if offset > size:
+                os.remove(tmp_path)
+                offset = 0
+
+            try:
+                if offset < size:
+                    async with self.ftp_pool.connection(db_id, info) as ftp:
+                        # KZTimer writes the file in place, so it may have changed while we backed off; resuming would mix two versions.
+                        if attempt > 0:
+                            current = await asyncio.wait_for(self._remote_file_info(ftp, info["ftp_dbpath"]), ftp_timeout)
+                            if current != remote:
+                                remote.update(current)
+                                size = int(remote["size"])
+                                manifest["partial"] = remote["modify"]
+                                self._save_manifest(db_id)
+                                if os.path.exists(tmp_path):
+                                    os.remove(tmp_path)
+                                offset = 0
+
+                        with open(tmp_path, "ab") as f:
+                            async with ftp.download_stream(info["ftp_dbpath"], offset=offset) as stream:
+                                async for block in stream.iter_by_block():
+                                    f.write(block)
+            except (OSError, asyncio.TimeoutError, aioftp.StatusCodeError):
+                if attempt == download_attempts - 1:
+                    raise
+                await asyncio.sleep(download_backoff ** attempt)
+                continue
+
+            if os.path.getsize(tmp_path) == size:
+                manifest["partial"] = None
+                return
+
+        os.remove(tmp_path)
+        manifest["partial"] = None
+        raise OSError("Downloaded database does not match the remote size of {} bytes.".format(size))
+
+    def _table_columns(self, con: sqlite3.Connection, schema: str, table: str) -> List[str]:
+        return [r[1] for r in con.execute("PRAGMA {}.table_info({});".format(schema, table))]
+
+    def _merge_snapshot(self, con: sqlite3.Connection, source: str) -> Dict[str, Any]:
+        con.execute("ATTACH DATABASE ? AS snap;", (source,))
+
+        for table in delta_keys:
+            if self._table_columns(con, "main", table) != self._table_columns(con, "snap", table):
+                return None
+        if not self._table_columns(con, "main", "kz_profile"):
+            return None
+
+        changes = {"tables": set(), "maps": set(), "renamed": False}
+
+        for table, keys in delta_keys.items():
+            k = ", ".join(keys)
+            con.execute("CREATE TEMP TABLE kz_delta AS SELECT * FROM snap.{0} EXCEPT SELECT * FROM main.{0};".format(table))
+            con.execute("CREATE TEMP TABLE kz_removed AS SELECT {1} FROM main.{0} EXCEPT SELECT {1} FROM snap.{0};".format(table, k))
+
+            if con.execute("SELECT EXISTS (SELECT 1 FROM temp.kz_delta) OR EXISTS (SELECT 1 FROM temp.kz_removed);").fetchone()[0]:
+                changes["tables"].add(table)
+
+                if table == "playertimes":
+                    changes["maps"].update(r[0] for r in con.execute("SELECT mapname FROM temp.kz_delta UNION SELECT mapname FROM temp.kz_removed;"))
+                elif table == "playerrank":
+                    renamed = [r[0] for r in con.execute("SELECT d.steamid FROM temp.kz_delta as d INNER JOIN main.playerrank as p on p.steamid = d.steamid WHERE p.name IS NOT d.name;")]
+                    if renamed:
+                        changes["renamed"] = True
+                        changes["maps"].update(r[0] for r in con.execute("SELECT DISTINCT mapname FROM main.playertimes WHERE steamid IN ({});".format(", ".join("?" * len(renamed))), renamed))
+
+                con.execute("DELETE FROM main.{0} WHERE ({1}) IN (SELECT {1} FROM temp.kz_removed UNION SELECT {1} FROM temp.kz_delta);".format(table, k))
+                con.execute("INSERT INTO main.{0} SELECT * FROM temp.kz_delta;".format(table))
+
+            con.execute("DROP TABLE temp.kz_delta;")
+            con.execute("DROP TABLE temp.kz_removed;")
+
+        if "playertimes" in changes["tables"]:
+            con.execute("CREATE TEMP TABLE kz_maps (mapname);")
+            con.executemany("INSERT INTO temp.kz_maps VALUES (?);", [(m,) for m in changes["maps"]])
+            con.execute("DELETE FROM main.kz_maprank WHERE mapname IN (SELECT mapname FROM temp.kz_maps);")
+            con.execute("INSERT INTO main.kz_maprank " + maprank_select.format(" AND mapname IN (SELECT mapname FROM temp.kz_maps)"))
+
+        # Percentiles move for everyone when anyone improves, so profiles are rebuilt in one pass rather than per player.
+        if changes["tables"] & {"playerrank", "playertimes", "playerjumpstats3"}:
+            con.execute("DELETE FROM main.kz_profile;")
+            con.execute("INSERT INTO main.kz_profile " + profile_select)
+
+        return changes
+
+    def _build_derived_database(self, source: str, destination: str, incremental: bool) -> Dict[str, Any]:
+        tmp_path = destination + ".tmp"
+
+        if incremental and os.path.exists(destination):
+            shutil.copyfile(destination, tmp_path)
+
+            con = sqlite3.connect(tmp_path)
+            try:
+                con.execute("PRAGMA journal_mode = OFF")
+                con.execute("PRAGMA synchronous = OFF")
+                changes = self._merge_snapshot(con, source)
+                if changes is not None:
+                    con.commit()
+            finally:
+                con.close()
+
+            if changes is not None:
+                os.replace(tmp_path, destination)
+                return changes
+
+        shutil.copyfile(source, tmp_path)
+
+        con = sqlite3.connect(tmp_path)
+        try:
+            con.execute("PRAGMA journal_mode = OFF")
+            con.execute("PRAGMA synchronous = OFF")
+            for statement in derived_statements:
+                con.execute(statement)
+            con.execute("ANALYZE")
+            con.commit()
+        finally:
+            con.close()
+
+        os.replace(tmp_path, destination)
+        return None
+
+    def _carry_over_caches(self, db_id: str, old_version: Any, new_version: Any, changes: Dict[str, Any]):
+        server_id = db_id.partition("/")[0]
+        if changes is None:
+            self.responses.invalidate(server_id)
+            return
+
+        jumps_changed = "playerjumpstats3" in changes["tables"] or changes["renamed"]
+
+        def stale(key: Tuple) -> bool:
+            if key[1] in ("records", "jumptop"):
+                return jumps_changed
+            if key[1] == "recent":
+                return "LatestRecords" in changes["tables"]
+            if key[1] == "maptop":
+                return key[2] in changes["maps"]
+            return True
+
+        self.responses.retag(server_id, db_id, old_version, new_version, stale)
+
+        if not jumps_changed and self.records.get(db_id, (None,))[0] == old_version:
+            self.records[db_id] = (new_version, self.records[db_id][1])
+        if "playertimes" not in changes["tables"] and self.map_indexes.get(db_id, (None,))[0] == old_version:
+            self.map_indexes[db_id] = (new_version, self.map_indexes[db_id][1])
+
+    async def _sync_database(self, db_id: str):
+        info = self._db_info(db_id)
+        manifest = self._get_manifest(db_id)
+        db_path = self._database_path(db_id)
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        start = time.time()
+
+        async with self.ftp_pool.connection(db_id, info) as ftp:
+            remote = await asyncio.wait_for(self._remote_file_info(ftp, info["ftp_dbpath"]), ftp_timeout)
+
+        if not self._database_is_current(db_id, remote):
+            await self._download_database(db_id, remote)
+            os.replace(db_path + ".tmp", db_path)
+            manifest["size"] = remote["size"]
+            manifest["modify"] = remote["modify"]
+
+        # The derived copy records which download it was built from, so a failed build is retried on the next sync.
+        built = [manifest["size"], manifest["modify"]]
+        if manifest["derived_from"] != built or not os.path.exists(self._derived_path(db_id)):
+            old_records = self.records.get(db_id)
+            changes = await self.bot.loop.run_in_executor(None, self._build_derived_database, db_path, self._derived_path(db_id), info["incremental_sync"])
+            manifest["derived_from"] = built
+            old_version = manifest["synced"]
+            manifest["synced"] = time.time()
+            manifest["rebuild"] = "full" if changes is None else "incremental ({} table{} changed)".format(len(changes["tables"]), "" if len(changes["tables"]) == 1 else "s")
+            self._carry_over_caches(db_id, old_version, manifest["synced"], changes)
+            await self._jump_records(db_id)
+            await self._map_index(db_id)
+            await self._announce_new_records(db_id, old_records[1] if old_records else None)
+
+        manifest["checked"] = time.time()
+        manifest["sync_duration"] = manifest["checked"] - start
+        manifest["last_error"] = None
+        self._save_manifest(db_id)
+
+    def _start_sync(self, db_id: str) -> asyncio.Task:
+        sync = self.syncs.get(db_id)
+        if sync is None:
+            sync = self.bot.loop.create_task(self._sync_database(db_id))
+            sync.add_done_callback(lambda t: self._finish_sync(db_id, t))
+            self.syncs[db_id] = sync
+        return sync
+
+    def _finish_sync(self, db_id: str, sync: asyncio.Task):
+        if self.syncs.get(db_id) is sync:
+            del self.syncs[db_id]
+
+        if not self._db_exists(db_id):
+            return
+        if not sync.cancelled() and sync.exception():
+            self._get_manifest(db_id)["last_error"] = str(sync.exception())
+            self._save_manifest(db_id)
+
+    async def _update_database(self, db_id: str, force: bool=False):
+        if not force and os.path.exists(self._derived_path(db_id)) and not self._database_is_stale(db_id):
+            return
+
+        with self.latency.span("sync"):
+            await asyncio.shield(self._start_sync(db_id))
+
+    async def _ensure_database(self, db_id: str):
+        self._start_refresher(db_id)
+
+        if not os.path.exists(self._derived_path(db_id)):
+            await self._update_database(db_id, force=True)
+        elif self._database_is_stale(db_id):
+            self._start_sync(db_id)
+
+    async def _ensure_databases(self, server_id: str):
+        # Other game servers never hold up a command: they sync in the background and are left out of the results
+        # until their first snapshot exists. Their errors are kept in their manifests.
+        for db_id in self._db_ids(server_id)[1:]:
+            if self._check_settings(db_id):
+                self._start_refresher(db_id)
+                if not os.path.exists(self._derived_path(db_id)) or self._database_is_stale(db_id):
+                    self._start_sync(db_id)
+
+        if self._check_settings(server_id):
+            await self._ensure_database(server_id)
+
+    async def _refresh_database(self, db_id: str):
+        while True:
+            try:
+                await self._update_database(db_id, force=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                # Sync errors are also kept in the manifest for kzset status; one bad sync must not stop the refresher.
+                print("Background sync of {} failed: {!r}".format(db_id, err))
+            await asyncio.sleep(self._db_info(db_id)["sync_interval"])
+
+    def _start_refresher(self, db_id: str, restart: bool=False):
+        task = self.refreshers.get(db_id)
+        if task and not task.done():
+            if not restart:
+                return
+            task.cancel()
+
+        if self._check_settings(db_id):
+            self.refreshers[db_id] = self.bot.loop.create_task(self._refresh_database(db_id))
+
+    async def _fetchone(self, db_id: str, query: str, params: Tuple=()) -> sqlite3.Row:
+        return await self.queries.fetchone(self._derived_path(db_id), self._get_manifest(db_id)["synced"], query, params)
+
+    async def _fetchall(self, db_id: str, query: str, params: Tuple=()) -> List[sqlite3.Row]:
+        return await self.queries.fetchall(self._derived_path(db_id), self._get_manifest(db_id)["synced"], query, params)
+
+    async def _get_json(self, url: str) -> Dict[str, Any]:
+        async with self.http.get(url) as res:
+            return json.loads(await res.text())
 
     async def _steam_url_to_text_id(self, server_id: str, vanityurl: str) -> str:
+        cached, text_id = self.steam_ids.get(vanityurl)
+        if cached:
+            if text_id is None:
+                raise SteamUrlError("'{}' could not be resolved to a Steam vanity URL.".format(vanityurl))
+            return text_id
+
         api_key = self.settings[server_id]["steam_api_key"]
 
         url = "http://api.steampowered.com/ISteamUser/ResolveVanityURL/v0001/?key={}&vanityurl={}".format(api_key, vanityurl)
 
-        steam64_id = None
-        async with aiohttp.get(url) as res:
-            response = json.loads(await res.text())["response"]
-            if response["success"] != 1:
-                raise SteamUrlError("'{}' could not be resolved to a Steam vanity URL.".format(vanityurl))
-            steam64_id = int(response["steamid"])
+        with self.latency.span("steam"):
+            try:
+                response = (await asyncio.wait_for(self._get_json(url), steam_timeout))["response"]
+            except (asyncio.TimeoutError, aiohttp.ClientError, ValueError, KeyError) as err:
+                raise SteamApiError("The Steam API could not be reached.") from err
+        if response["success"] != 1:
+            self.steam_ids.put(vanityurl, None)
+            raise SteamUrlError("'{}' could not be resolved to a Steam vanity URL.".format(vanityurl))
+        steam64_id = int(response["steamid"])
 
         account_id = steam64_id & ((1 << 32) - 1)
         universe = (steam64_id >> 56) & ((1 << 8) - 1)
@@ -130,7 +1345,214 @@ class Kz:
         J = account_id & 1
         K = (account_id >> 1) & ((1 << 31) - 1)
 
-        return "STEAM_{}:{}:{}".format(I, J, K)
+        text_id = "STEAM_{}:{}:{}".format(I, J, K)
+        self.steam_ids.put(vanityurl, text_id)
+        return text_id
+
+    async def _cached_response(self, server_id: str, key: Tuple, render, *args) -> str:
+        version = self._snapshot_version(server_id)
+        key = (server_id,) + key
+
+        response = self.responses.get(key, version)
+        if response is None:
+            response = await render(server_id, *args)
+            self.responses.put(key, version, response)
+        return response
+
+    def _result_pages(self, server_id: str, query: str, params: Tuple, key, reverse: bool=False, limit: int=None) -> ResultPages:
+        sources = [(self._db_label(d), self._derived_path(d), self._get_manifest(d)["synced"]) for d in self._snapshot_ids(server_id)]
+        return ResultPages(self.queries, sources, query, params, key, reverse, limit, gather=self.latency.gather)
+
+    async def _page_text(self, pages: ResultPages, n: int, format_page) -> str:
+        rows = await pages.page(n)
+        with self.latency.span("render"):
+            text = format_page(rows or [], n * pages.size, pages.count if pages.done else pages.limit, len(pages.sources) > 1)
+        if n > 0 or not pages.done:
+            text += "\nPage {}{}".format(n + 1, " of {}".format(len(pages.pages)) if pages.done else "")
+        return cf.box(text)
+
+    async def _send_pages(self, context: commands.context.Context, key: Tuple, open_pages, format_page):
+        """Sends the first page of a result and lets the author flip through the rest with reactions.
+        Only the first page is cached; later pages are fetched from a single query as they are requested."""
+
+        server_id = context.message.server.id
+        version = self._snapshot_version(server_id)
+        key = (server_id,) + key
+
+        pages = None
+        first = self.responses.get(key, version)
+        if first is None:
+            pages = open_pages()
+            first = (await self._page_text(pages, 0, format_page), not pages.done)
+            self.responses.put(key, version, first)
+
+        with self.latency.span("send"):
+            message = await self.bot.say(first[0])
+        # Waiting for reactions is idle time, so the command's total ends here and page flips are timed on their own.
+        self.latency.end()
+        if not first[1]:
+            return
+
+        if pages is None:
+            pages = open_pages()
+
+        try:
+            await self.bot.add_reaction(message, page_previous)
+            await self.bot.add_reaction(message, page_next)
+
+            n = 0
+            while True:
+                res = await self.bot.wait_for_reaction([page_previous, page_next], user=context.message.author, timeout=page_timeout, message=message)
+                if res is None:
+                    break
+
+                try:
+                    await self.bot.remove_reaction(message, res.reaction.emoji, res.user)
+                except discord.HTTPException:
+                    pass
+
+                m = n - 1 if res.reaction.emoji == page_previous else n + 1
+                with self.latency.span("flip"):
+                    if m < 0 or await pages.page(m) is None:
+                        continue
+
+                    n = m
+                    text = await self._page_text(pages, n, format_page)
+                    with self.latency.span("send"):
+                        await self.bot.edit_message(message, text)
+        finally:
+            pages.close()
+
+        try:
+            await self.bot.clear_reactions(message)
+        except discord.HTTPException:
+            pass
+
+    async def _map_index(self, db_id: str) -> MapIndex:
+        version = self._get_manifest(db_id)["synced"]
+        cached = self.map_indexes.get(db_id)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        index = MapIndex([r["mapname"] for r in await self._fetchall(db_id, mapnames_query)])
+        self.map_indexes[db_id] = (version, index)
+        return index
+
+    async def _combined_map_index(self, server_id: str) -> MapIndex:
+        db_ids = self._snapshot_ids(server_id)
+        if len(db_ids) == 1:
+            return await self._map_index(db_ids[0])
+
+        version = self._snapshot_version(server_id)
+        cached = self.combined_map_indexes.get(server_id)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        indexes = await self.latency.gather(*[self._map_index(d) for d in db_ids])
+        index = MapIndex(list({m for i in indexes for m in i.canonical.values()}))
+        self.combined_map_indexes[server_id] = (version, index)
+        return index
+
+    async def _resolve_mapname(self, server_id: str, mapname: str, combined: bool=False) -> str:
+        index = await (self._combined_map_index(server_id) if combined else self._map_index(server_id))
+        real_mapname, suggestions = index.resolve(mapname)
+        if real_mapname is None:
+            if suggestions:
+                await self.bot.reply(cf.warning("Could not find a single map matching `{}`. Did you mean: {}?".format(mapname, ", ".join(suggestions))))
+            else:
+                await self.bot.reply(cf.warning("No map matches `{}`.".format(mapname)))
+        return real_mapname
+
+    async def _jump_records(self, db_id: str) -> List[List[Any]]:
+        version = self._get_manifest(db_id)["synced"]
+        cached = self.records.get(db_id)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        rows = []
+
+        r = await self._fetchone(db_id, jumptop_queries["ljblock"], (1,))
+        if r:
+            rows.append(["BlockLJ", "{}|{}".format(r["ljblockdist"], round(r["ljblockrecord"], 1)), r["ljblockstrafes"], r["name"]])
+        else:
+            rows.append(["BlockLJ", "--|--", "--" "--" "--", "--", "--"])
+
+        for r in await self._fetchall(db_id, jumprecords_query):
+            rows.append([r["jumptype"], round(r["distance"], 3), r["strafes"], r["name"]])
+
+        jumps = ["BlockLJ", "LJ", "Bhop", "CJ", "D.-Bhop", "M.-Bhop", "LAJ", "WJ"]
+        in_rows = [x[0] for x in rows]
+
+        for j in jumps:
+            if j not in in_rows:
+                rows.append([j, "--", "--" "--" "--", "--", "--"])
+
+        self.records[db_id] = (version, rows)
+        return rows
+
+    async def _announce_new_records(self, db_id: str, old_records: List[List[Any]]):
+        info = self._db_info(db_id)
+        channel = self.bot.get_channel(info["notify_channel"]) if info["notify_channel"] else None
+        if channel is None:
+            self.leaders.pop(db_id, None)
+            return
+
+        leaders = defaultdict(dict)
+        for r in await self._fetchall(db_id, leaders_query, (info["notify_top"],)):
+            leaders[(r["mapname"], r["runtype"])][r["steamid"]] = r
+
+        previous = self.leaders.get(db_id)
+        self.leaders[db_id] = leaders
+        if previous is None:
+            return
+
+        lines = []
+        for (mapname, runtype), entries in sorted(leaders.items()):
+            before = previous.get((mapname, runtype), {})
+            for steamid, r in sorted(entries.items(), key=lambda e: e[1]["rank"]):
+                if steamid not in before or r["runtime"] < before[steamid]["runtime"]:
+                    lines.append("{} set the #{} {} time on {}: {}".format(r["name"], r["rank"], runtype.upper(), mapname, self._seconds_to_time_string(r["runtime"])))
+
+        if old_records:
+            old = {row[0]: row for row in old_records}
+            for row in await self._jump_records(db_id):
+                # Only a longer jump is a new record; a renamed holder or a record that went down is not.
+                if self._record_distance(row) > self._record_distance(old.get(row[0], [row[0], "--"])):
+                    lines.append("{} set a new {} record: {}".format(row[3], row[0], row[1]))
+
+        if not lines:
+            return
+
+        if len(lines) > max_announcements:
+            lines = lines[:max_announcements] + ["...and {} more.".format(len(lines) - max_announcements)]
+
+        title = "New records"
+        if len(self._db_ids(db_id.partition("/")[0])) > 1:
+            title = "New records on {}".format(self._db_label(db_id))
+
+        try:
+            await self.bot.send_message(channel, cf.box("{}\n{}".format(title, "\n".join(lines))))
+        except discord.HTTPException:
+            pass
+
+    async def _steam_urls_to_text_ids(self, server_id: str, vanityurls: List[str]) -> Dict[str, str]:
+        lookups = asyncio.Semaphore(steam_lookup_concurrency)
+
+        async def resolve(vanityurl: str) -> str:
+            async with lookups:
+                try:
+                    return await self._steam_url_to_text_id(server_id, vanityurl)
+                except (SteamUrlError, SteamApiError):
+                    return None
+
+        text_ids = await self.latency.gather(*[resolve(u) for u in vanityurls])
+        return dict(zip(vanityurls, text_ids))
+
+    def _record_distance(self, row: List[Any]) -> Tuple[float, ...]:
+        try:
+            return tuple(float(d) for d in str(row[1]).split("|"))
+        except ValueError:
+            return (-1.0,)
 
     def _seconds_to_time_string(self, seconds: int) -> str:
         m, s = divmod(seconds, 60)
@@ -145,12 +1567,13 @@ class Kz:
     async def _playerjumps(self, context: commands.context.Context, player_url: str):
         """Gets a player's best jumps. You must provide the STEAM VANITY URL of the player, NOT the in-game name."""
 
+        self.latency.begin((context.invoked_subcommand or context.command).qualified_name)
         await self.bot.type()
 
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings_writer.save()
 
         if not self._check_settings(server.id):
             await self.bot.reply(cf.error("You need to set up this cog before you can use it. Use `{}kzset`.".format(context.prefix)))
@@ -162,18 +1585,13 @@ class Kz:
         except SteamUrlError as err:
             await self.bot.reply(cf.error("Could not resolve Steam vanity URL."))
             return
+        except SteamApiError:
+            await self.bot.reply(cf.error("Could not reach the Steam API. Try again later."))
+            return
 
-        await self._update_database(server.id)
-
-        con = sqlite3.connect("data/kz/{}/kztimer-sqlite.sq3".format(server.id))
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
+        await self._ensure_database(server.id)
 
-        cur.execute(player_jumps_query, (steamid,))
-
-        stats = cur.fetchone()
-        cur.close()
-        con.close()
+        stats = await self._fetchone(server.id, player_jumps_query, (steamid,))
 
         if not stats:
             await self.bot.reply(cf.warning("Player has no jumpstats in the server."))
@@ -204,20 +1622,91 @@ class Kz:
             await self.bot.reply(cf.warning("Player has no jumpstats in the server."))
             return
 
-        table = tabulate(rows, headers, tablefmt="orgtbl")
+        with self.latency.span("render"):
+            table = tabulate(rows, headers, tablefmt="orgtbl")
 
-        await self.bot.say(cf.box("{}\n{}".format(title, table)))
+        with self.latency.span("send"):
+            await self.bot.say(cf.box("{}\n{}".format(title, table)))
+
+    @commands.command(pass_context=True, no_pm=True, name="comparejumps")
+    async def _comparejumps(self, context: commands.context.Context, *player_urls: str):
+        """Compares the best jumps of several players. You must provide the STEAM VANITY URLs of the players, NOT their in-game names."""
+
+        self.latency.begin((context.invoked_subcommand or context.command).qualified_name)
+        await self.bot.type()
+
+        server = context.message.server
+        if server.id not in self.settings:
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings_writer.save()
+
+        if not self._check_settings(server.id):
+            await self.bot.reply(cf.error("You need to set up this cog before you can use it. Use `{}kzset`.".format(context.prefix)))
+            return
+
+        urls = list(OrderedDict.fromkeys(player_urls))
+        if not urls:
+            await self.bot.reply(cf.error("You must provide at least one Steam vanity URL."))
+            return
+        if len(urls) > max_compared_players:
+            await self.bot.reply(cf.error("You can compare at most {} players at once.".format(max_compared_players)))
+            return
+
+        text_ids, _ = await self.latency.gather(self._steam_urls_to_text_ids(server.id, urls), self._ensure_database(server.id))
+
+        steamids = [text_ids[u] for u in urls if text_ids[u]]
+        unresolved = [u for u in urls if not text_ids[u]]
+
+        results = []
+        if steamids:
+            results = await self._fetchall(server.id, players_jumps_query.format(", ".join("?" * len(steamids))), tuple(steamids))
+
+        by_steamid = {r["steamid"]: r for r in results}
+        headers = ["Player"] + [name for name, column in compared_jumps]
+        rows = []
+
+        for steamid in steamids:
+            stats = by_steamid.get(steamid)
+            if not stats:
+                continue
+            row = [stats["name"]]
+            for name, column in compared_jumps:
+                if stats[column] == -1:
+                    row.append("--")
+                elif column == "ljblockrecord":
+                    row.append("{}|{}".format(stats["ljblockdist"], round(stats["ljblockrecord"], 1)))
+                else:
+                    row.append(round(stats[column], 3))
+            rows.append(row)
+
+        notes = []
+        if unresolved:
+            notes.append("Could not resolve: {}".format(", ".join(unresolved)))
+        if len(rows) < len(steamids):
+            notes.append("{} player{} had no jumpstats in the server.".format(len(steamids) - len(rows), "" if len(steamids) - len(rows) == 1 else "s"))
+
+        if not rows:
+            await self.bot.reply(cf.warning("None of those players have jumpstats in the server.{}".format("\n" + "\n".join(notes) if notes else "")))
+            return
+
+        title = "Jumpstats comparison"
+        with self.latency.span("render"):
+            table = tabulate(rows, headers, tablefmt="orgtbl")
+
+        with self.latency.span("send"):
+            await self.bot.say(cf.box("{}\n{}{}".format(title, table, "\n" + "\n".join(notes) if notes else "")))
 
     @commands.command(pass_context=True, no_pm=True, name="playermap")
     async def _playermap(self, context: commands.context.Context, player_url: str, mapname: str):
         """Gets a certain player's times on the given map."""
 
+        self.latency.begin((context.invoked_subcommand or context.command).qualified_name)
         await self.bot.type()
 
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings_writer.save()
 
         if not self._check_settings(server.id):
             await self.bot.reply(cf.error("You need to set up this cog before you can use it. Use `{}kzset`.".format(context.prefix)))
@@ -229,18 +1718,17 @@ class Kz:
         except SteamUrlError as err:
             await self.bot.reply(cf.error("Could not resolve Steam vanity URL."))
             return
+        except SteamApiError:
+            await self.bot.reply(cf.error("Could not reach the Steam API. Try again later."))
+            return
 
-        mn = "%{}%".format(mapname)
-
-        await self._update_database(server.id)
-
-        con = sqlite3.connect("data/kz/{}/kztimer-sqlite.sq3".format(server.id))
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
+        await self._ensure_database(server.id)
 
-        cur.execute(player_maptime_query, (steamid, mn))
+        real_mapname = await self._resolve_mapname(server.id, mapname)
+        if not real_mapname:
+            return
 
-        r = cur.fetchone()
+        r = await self._fetchone(server.id, player_maptime_query, (steamid, real_mapname))
         if not r:
             await self.bot.say(cf.box("Player has no times on the given map."))
             return
@@ -250,38 +1738,92 @@ class Kz:
         rows = []
 
         if r["runtime"] > -1.0:
-            cur.execute(player_mapranktotal_queries["tp"], (steamid, real_mapname, real_mapname, real_mapname))
-            tpr = cur.fetchone()
-            cur.close()
-            rows.append(["TP", self._seconds_to_time_string(r["runtime"]), r["teleports"], "{}/{}".format(tpr["rank"], tpr["tot"])])
+            rows.append(["TP", self._seconds_to_time_string(r["runtime"]), r["teleports"], "{}/{}".format(r["tp_rank"], r["tp_tot"])])
         else:
             rows.append(["TP", "--", "--", "--"])
 
         if r["runtimepro"] > -1.0:
-            cur.execute(player_mapranktotal_queries["pro"], (steamid, real_mapname, real_mapname, real_mapname))
-            pror = cur.fetchone()
-            cur.close()
-            rows.append(["PRO", self._seconds_to_time_string(r["runtimepro"]), r["teleports_pro"], "{}/{}".format(pror["rank"], pror["tot"])])
+            rows.append(["PRO", self._seconds_to_time_string(r["runtimepro"]), r["teleports_pro"], "{}/{}".format(r["pro_rank"], r["pro_tot"])])
         else:
             rows.append(["PRO", "--", "--", "--"])
 
-        con.close()
-
         title = "Map times for {} on {}".format(r["name"], real_mapname)
-        table = tabulate(rows, headers, tablefmt="orgtbl")
+        with self.latency.span("render"):
+            table = tabulate(rows, headers, tablefmt="orgtbl")
+
+        with self.latency.span("send"):
+            await self.bot.say(cf.box("{}\n{}".format(title, table)))
+
+    @commands.command(pass_context=True, no_pm=True, name="kzprofile")
+    async def _kzprofile(self, context: commands.context.Context, player_url: str):
+        """Gets a player's profile: map completions, best ranks and how their jumps compare to everyone else's. You must provide the STEAM VANITY URL of the player, NOT the in-game name."""
+
+        self.latency.begin((context.invoked_subcommand or context.command).qualified_name)
+        await self.bot.type()
 
-        await self.bot.say(cf.box("{}\n{}".format(title, table)))
+        server = context.message.server
+        if server.id not in self.settings:
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings_writer.save()
+
+        if not self._check_settings(server.id):
+            await self.bot.reply(cf.error("You need to set up this cog before you can use it. Use `{}kzset`.".format(context.prefix)))
+            return
+
+        steamid = None
+        try:
+            steamid = await self._steam_url_to_text_id(server.id, player_url)
+        except SteamUrlError:
+            await self.bot.reply(cf.error("Could not resolve Steam vanity URL."))
+            return
+        except SteamApiError:
+            await self.bot.reply(cf.error("Could not reach the Steam API. Try again later."))
+            return
+
+        await self._ensure_database(server.id)
+
+        profile, ranks = await self.latency.gather(self._fetchone(server.id, profile_query, (steamid,)), self._fetchall(server.id, profile_ranks_query, (steamid, profile_best_ranks)))
+
+        if not profile:
+            await self.bot.reply(cf.warning("Player has no stats in the server."))
+            return
+
+        lines = ["Profile: {}".format(profile["name"])]
+        lines.append("Maps completed: {} (TP {}, PRO {})".format(profile["maps"], profile["tp_maps"], profile["pro_maps"]))
+        if profile["maps"]:
+            lines.append("Map records: TP {}, PRO {}, top 10 finishes: {}".format(profile["tp_firsts"], profile["pro_firsts"], profile["top10"]))
+            lines.append("Average map percentile: {:.1f}%".format(profile["map_percentile"]))
+        if ranks:
+            lines.append("Best ranks: {}".format(", ".join("{} {} {}/{}".format(r["mapname"], r["runtype"].upper(), r["rank"], r["tot"]) for r in ranks)))
+
+        headers = ["Type", "Distance", "Percentile"]
+        rows = []
+        for name, column in compared_jumps:
+            if profile["{}_percentile".format(column)] is None:
+                continue
+            if column == "ljblockrecord":
+                rows.append([name, "{}|{}".format(profile["ljblockdist"], round(profile["ljblockrecord"], 1)), "{:.1f}%".format(profile["{}_percentile".format(column)])])
+            else:
+                rows.append([name, round(profile[column], 3), "{:.1f}%".format(profile["{}_percentile".format(column)])])
+
+        if rows:
+            with self.latency.span("render"):
+                lines.append(tabulate(rows, headers, tablefmt="orgtbl"))
+
+        with self.latency.span("send"):
+            await self.bot.say(cf.box("\n".join(lines)))
 
     @commands.command(pass_context=True, no_pm=True, name="recent", aliases=["latest"])
     async def _recent(self, context: commands.context.Context, limit: str="10"):
         """Gets the recent runs per map and run type."""
 
+        self.latency.begin((context.invoked_subcommand or context.command).qualified_name)
         await self.bot.type()
 
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings_writer.save()
 
         if not self._check_settings(server.id):
             await self.bot.reply(cf.error("You need to set up this cog before you can use it. Use `{}kzset`.".format(context.prefix)))
@@ -294,46 +1836,44 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
-        await self._update_database(server.id)
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
 
-        con = sqlite3.connect("data/kz/{}/kztimer-sqlite.sq3".format(server.id))
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
+        await self._ensure_databases(server.id)
 
-        cur.execute(recent_query, (lim,))
+        await self._send_pages(context, ("recent", lim), partial(self._result_pages, server.id, recent_query, (lim,), lambda r: r["date"], reverse=True, limit=lim), self._format_recent)
 
-        r = cur.fetchone()
-        if not r:
-            await self.bot.say(cf.box("No recent runs found."))
-            return
+    def _format_recent(self, results: List[Tuple[str, sqlite3.Row]], start: int, total: int, multi: bool) -> str:
+        if not results:
+            return "No recent runs found."
 
         headers = ["Map", "Time", "Teleports", "Player"]
+        if multi:
+            headers.append("Server")
         
         rows = []
-        count = 0
-        while r:
-            count += 1
+        for label, r in results:
             rows.append([r["map"], self._seconds_to_time_string(r["runtime"]), r["teleports"], r["name"]])
-            r = cur.fetchone()
-
-        cur.close()
-        con.close()
+            if multi:
+                rows[-1].append(label)
 
-        title = "Recent {} record runs".format(min(count, lim))
+        title = "Recent {} record runs".format(total)
         table = tabulate(rows, headers, tablefmt="orgtbl")
 
-        await self.bot.say(cf.box("{}\n{}".format(title, table)))
+        return "{}\n{}".format(title, table)
 
     @commands.command(pass_context=True, no_pm=True, name="maptop")
     async def _maptop(self, context: commands.context.Context, mapname: str, runtype: str="all", limit: str="10"):
         """Gets the top times for a map. Optionally provide the run type (all by default) and the limit (10 by default)."""
 
+        self.latency.begin((context.invoked_subcommand or context.command).qualified_name)
         await self.bot.type()
 
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings_writer.save()
 
         if not self._check_settings(server.id):
             await self.bot.reply(cf.error("You need to set up this cog before you can use it. Use `{}kzset`.".format(context.prefix)))
@@ -346,72 +1886,70 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
+
         rt = runtype.strip().lower()
 
         if rt not in ["all", "tp", "pro"]:
             await self.bot.reply(cf.error("The runtype must be one of `all`, `tp`, or `pro`."))
             return
 
-        mn = "%{}%".format(mapname)
+        await self._ensure_databases(server.id)
 
-        await self._update_database(server.id)
-
-        con = sqlite3.connect("data/kz/{}/kztimer-sqlite.sq3".format(server.id))
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-
-        if rt == "all":
-            cur.execute(maptop_queries[rt], (mn, mn, lim))
-        else:
-            cur.execute(maptop_queries[rt], (mn, lim))
-
-        r = cur.fetchone()
-        if not r:
-            await self.bot.say(cf.box("No times found."))
+        real_mapname = await self._resolve_mapname(server.id, mapname, combined=True)
+        if not real_mapname:
             return
 
-        real_mapname = r["mapname"]
+        params = (real_mapname, real_mapname, lim) if rt == "all" else (real_mapname, lim)
+        await self._send_pages(context, ("maptop", real_mapname, rt, lim), partial(self._result_pages, server.id, maptop_queries[rt], params, lambda r: r["overall"], limit=lim), partial(self._format_maptop, real_mapname, rt))
+
+    def _format_maptop(self, mapname: str, rt: str, results: List[Tuple[str, sqlite3.Row]], start: int, total: int, multi: bool) -> str:
+        if not results:
+            return "No times found."
 
         headers = None
         if rt == "pro":
             headers = ["Rank", "Time", "Player"]
         else:
             headers = ["Rank", "Time", "Teleports", "Player"]
+        if multi:
+            headers.append("Server")
 
-        rank = 0
+        rank = start
         rows = []
-        while r:
+        for label, r in results:
             rank += 1
             if rt == "pro":
                 rows.append([rank, self._seconds_to_time_string(r["overall"]), r["name"]])
             else:
                 rows.append([rank, self._seconds_to_time_string(r["overall"]), r["tp"], r["name"]])
-            r = cur.fetchone()
-
-        cur.close()
-        con.close()
+            if multi:
+                rows[-1].append(label)
 
-        title = "Top {} {}time{} on {}".format(min(rank, lim), "" if rt == "all" else rt.upper() + " ", "s" if rank > 1 else "", real_mapname)
+        title = "Top {} {}time{} on {}".format(total, "" if rt == "all" else rt.upper() + " ", "s" if total > 1 else "", mapname)
         table = tabulate(rows, headers, tablefmt="orgtbl")
 
-        await self.bot.say(cf.box("{}\n{}".format(title, table)))
+        return "{}\n{}".format(title, table)
 
     @commands.group(pass_context=True, no_pm=True, name="jumptop")
     async def _jumptop(self, context: commands.context.Context):
         """Gets the top stats for the given jump type. Optionally provide a limit (default is 10)."""
 
+        self.latency.begin((context.invoked_subcommand or context.command).qualified_name)
         await self.bot.type()
 
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings_writer.save()
 
         if not self._check_settings(server.id):
             await self.bot.reply(cf.error("You need to set up this cog before you can use it. Use `{}kzset`.".format(context.prefix)))
             return
 
-        await self._update_database(server.id)
+        await self._ensure_databases(server.id)
 
         if context.invoked_subcommand is None:
             await context.invoke(self._all)
@@ -420,41 +1958,33 @@ class Kz:
     async def _all(self, context: commands.context.Context):
         """Gets the record for every type of jump."""
 
-        con = sqlite3.connect("data/kz/{}/kztimer-sqlite.sq3".format(context.message.server.id))
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
+        server_id = context.message.server.id
 
-        headers = ["Type", "Distance", "Strafes", "Player"]
-        rows = []
+        response = await self._cached_response(server_id, ("records",), self._render_records)
+        with self.latency.span("send"):
+            await self.bot.say(response)
 
-        cur.execute(jumptop_queries["ljblock"], (1,))
+    async def _render_records(self, server_id: str) -> str:
+        db_ids = self._snapshot_ids(server_id)
+        headers = ["Type", "Distance", "Strafes", "Player"]
+        rows = None
 
-        r = cur.fetchone()
-        if r:
-            rows.append(["BlockLJ", "{}|{}".format(r["ljblockdist"], round(r["ljblockrecord"], 1)), r["ljblockstrafes"], r["name"]])
+        if len(db_ids) == 1:
+            rows = await self._jump_records(db_ids[0])
         else:
-            rows.append(["BlockLJ", "--|--", "--" "--" "--", "--", "--"])
-
-        cur.execute(jumprecords_query)
-        r = cur.fetchone()
-        while r:
-            rows.append([r["jumptype"], round(r["distance"], 3), r["strafes"], r["name"]])
-            r = cur.fetchone()
-
-        jumps = ["BlockLJ", "LJ", "Bhop", "CJ", "D.-Bhop", "M.-Bhop", "LAJ", "WJ"]
-        in_rows = [x[0] for x in rows]
-
-        for j in jumps:
-            if j not in in_rows:
-                rows.append([j, "--", "--" "--" "--", "--", "--"])
-
-        cur.close()
-        con.close()
+            headers.append("Server")
+            best = OrderedDict()
+            for db_id, records in zip(db_ids, await self.latency.gather(*[self._jump_records(d) for d in db_ids])):
+                for row in records:
+                    if row[0] not in best or self._record_distance(row) > self._record_distance(best[row[0]][1]):
+                        best[row[0]] = (db_id, row)
+            rows = [row[:4] + [self._db_label(db_id) if self._record_distance(row)[0] > -1.0 else "--"] for db_id, row in best.values()]
 
         title = "Jumpstat records"
-        table = tabulate(rows, headers, tablefmt="orgtbl")
+        with self.latency.span("render"):
+            table = tabulate(rows, headers, tablefmt="orgtbl")
 
-        await self.bot.say(cf.box("{}\n{}".format(title, table)))
+        return cf.box("{}\n{}".format(title, table))
 
     @_jumptop.command(pass_context=True, no_pm=True, name="blocklj", aliases=["blocklongjump", "BlockLJ", "BlockLj", "BlockLongJump", "BlockLongjump", "Blocklongjump"])
     async def _blocklj(self, context: commands.context.Context, limit: str="10"):
@@ -467,7 +1997,11 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
-        await self._jumptop_helper(context.message.server.id, "ljblock", "Block Longjump", lim)
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
+
+        await self._jumptop_helper(context, "ljblock", "Block Longjump", lim)
 
     @_jumptop.command(pass_context=True, no_pm=True, name="lj", aliases=["longjump", "LJ", "LongJump", "Longjump", "Lj"])
     async def _lj(self, context: commands.context.Context, limit: str="10"):
@@ -480,7 +2014,11 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
-        await self._jumptop_helper(context.message.server.id, "lj", "Longjump", lim)
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
+
+        await self._jumptop_helper(context, "lj", "Longjump", lim)
 
     @_jumptop.command(pass_context=True, no_pm=True, name="bhop", aliases=["bunnyhop", "Bhop", "BHop", "Bunnyhop", "BunnyHop"])
     async def _bhop(self, context: commands.context.Context, limit: str="10"):
@@ -493,7 +2031,11 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
-        await self._jumptop_helper(context.message.server.id, "bhop", "Bunnyhop", lim)
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
+
+        await self._jumptop_helper(context, "bhop", "Bunnyhop", lim)
 
     @_jumptop.command(pass_context=True, no_pm=True, name="multibhop", aliases=["multibunnyhop", "MultiBhop", "MultiBunnyhop", "MultiBunnyHop", "Multibhop", "mbhop", "MBhop"])
     async def _multibhop(self, context: commands.context.Context, limit: str="10"):
@@ -506,7 +2048,11 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
-        await self._jumptop_helper(context.message.server.id, "multibhop", "Multi-Bunnyhop", lim)
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
+
+        await self._jumptop_helper(context, "multibhop", "Multi-Bunnyhop", lim)
 
     @_jumptop.command(pass_context=True, no_pm=True, name="dropbhop", aliases=["dropbunnyhop", "DropBhop", "DropBunnyhop", "DropBunnyHop", "Dropbhop", "dbhop", "DBhop"])
     async def _dropbhop(self, context: commands.context.Context, limit: str="10"):
@@ -519,7 +2065,11 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
-        await self._jumptop_helper(context.message.server.id, "dropbhop", "Drop-Bunnyhop", lim)
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
+
+        await self._jumptop_helper(context, "dropbhop", "Drop-Bunnyhop", lim)
 
     @_jumptop.command(pass_context=True, no_pm=True, name="wj", aliases=["weirdjump", "WJ", "WeirdJump", "Weirdjump"])
     async def _wj(self, context: commands.context.Context, limit: str="10"):
@@ -532,7 +2082,11 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
-        await self._jumptop_helper(context.message.server.id, "wj", "Weirdjump", lim)
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
+
+        await self._jumptop_helper(context, "wj", "Weirdjump", lim)
 
     @_jumptop.command(pass_context=True, no_pm=True, name="laj", aliases=["ladderjump", "LaJ", "LAJ", "LadderJump", "Ladderjump"])
     async def _laj(self, context: commands.context.Context, limit: str="10"):
@@ -545,7 +2099,11 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
-        await self._jumptop_helper(context.message.server.id, "ladderjump", "Ladderjump", lim)
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
+
+        await self._jumptop_helper(context, "ladderjump", "Ladderjump", lim)
 
     @_jumptop.command(pass_context=True, no_pm=True, name="cj", aliases=["countjump", "CJ", "CountJump", "Countjump"])
     async def _cj(self, context: commands.context.Context, limit: str="10"):
@@ -558,43 +2116,48 @@ class Kz:
             await self.bot.reply(cf.error("The limit you provided is not a number."))
             return
 
-        await self._jumptop_helper(context.message.server.id, "cj", "Countjump", lim)
+        if lim < 1:
+            await self.bot.reply(cf.error("The limit must be at least 1."))
+            return
 
-    async def _jumptop_helper(self, server_id: str, jumptype: str, jumpname: str, lim: int):
-        con = sqlite3.connect("data/kz/{}/kztimer-sqlite.sq3".format(server_id))
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
+        await self._jumptop_helper(context, "cj", "Countjump", lim)
+
+    async def _jumptop_helper(self, context: commands.context.Context, jumptype: str, jumpname: str, lim: int):
+        key = None
+        if jumptype == "ljblock":
+            key = lambda r: (r["ljblockdist"], r["ljblockrecord"])
+        else:
+            key = lambda r: r["{}record".format(jumptype)]
 
-        cur.execute(jumptop_queries[jumptype], (lim,))
+        await self._send_pages(context, ("jumptop", jumptype, lim), partial(self._result_pages, context.message.server.id, jumptop_queries[jumptype], (lim,), key, reverse=True, limit=lim), partial(self._format_jumptop, jumptype, jumpname))
 
-        r = cur.fetchone()
-        if not r:
-            await self.bot.say(cf.box("No jumps found."))
-            return
+    def _format_jumptop(self, jumptype: str, jumpname: str, results: List[Tuple[str, sqlite3.Row]], start: int, total: int, multi: bool) -> str:
+        if not results:
+            return "No jumps found."
 
         headers = None
         if jumptype == "ljblock":
             headers = ["Rank", "Block", "Distance", "Strafes", "Player"]
         else:
             headers = ["Rank", "Distance", "Strafes", "Player"]
+        if multi:
+            headers.append("Server")
 
-        rank = 0
+        rank = start
         rows = []
-        while r:
+        for label, r in results:
             rank += 1
             if jumptype == "ljblock":
                 rows.append([rank, r["ljblockdist"], r["ljblockrecord"], r["ljblockstrafes"], r["name"]])
             else:
                 rows.append([rank, r["{}record".format(jumptype)], r["{}strafes".format(jumptype)], r["name"]])
-            r = cur.fetchone()
-
-        cur.close()
-        con.close()
+            if multi:
+                rows[-1].append(label)
 
-        title = "Top {} {}".format(min(rank, lim), jumpname)
+        title = "Top {} {}".format(total, jumpname)
         table = tabulate(rows, headers, tablefmt="orgtbl")
 
-        await self.bot.say(cf.box("{}\n{}".format(title, table)))
+        return "{}\n{}".format(title, table)
 
 def check_folders():
     if not os.path.exists("data/kz"):
@@ -607,6 +2170,11 @@ def check_files():
         print("Creating data/kz/settings.json...")
         dataIO.save_json(f, {})
 
+    f = "data/kz/steamids.json"
+    if not dataIO.is_valid_json(f):
+        print("Creating data/kz/steamids.json...")
+        dataIO.save_json(f, {})
+
 def setup(bot: commands.bot.Bot):
     check_folders()
     check_files()
@@ -629,15 +2197,50 @@ jumptop_queries = {
 }
 
 player_jumps_query = "SELECT db1.name, db2.bhoprecord, db2.bhoppre, db2.bhopmax, db2.bhopstrafes, db2.bhopsync, db2.bhopheight, db2.ljrecord, db2.ljpre, db2.ljmax, db2.ljstrafes, db2.ljsync, db2.ljheight, db2.multibhoprecord, db2.multibhoppre, db2.multibhopmax, db2.multibhopstrafes, db2.multibhopcount, db2.multibhopsync, db2.multibhopheight, db2.wjrecord, db2.wjpre, db2.wjmax, db2.wjstrafes, db2.wjsync, db2.wjheight, db2.dropbhoprecord, db2.dropbhoppre, db2.dropbhopmax, db2.dropbhopstrafes, db2.dropbhopsync, db2.dropbhopheight, db2.ljblockdist, db2.ljblockrecord, db2.ljblockpre, db2.ljblockmax, db2.ljblockstrafes, db2.ljblocksync, db2.ljblockheight, db2.ladderjumprecord, db2.ladderjumppre, db2.ladderjumpmax, db2.ladderjumpstrafes, db2.ladderjumpsync, db2.ladderjumpheight, db2.cjrecord, db2.cjpre, db2.cjmax, db2.cjstrafes, db2.cjsync, db2.cjheight FROM playerjumpstats3 as db2 INNER JOIN playerrank as db1 on db2.steamid = db1.steamid WHERE (db2.ladderjumprecord > -1.0 OR db2.wjrecord > -1.0 OR db2.dropbhoprecord > -1.0 OR db2.ljrecord > -1.0 OR db2.bhoprecord > -1.0 OR db2.multibhoprecord > -1.0 OR db2.cjrecord > -1.0) AND db2.steamid = ?;" # STEAMID
-player_maptime_query = "SELECT name, mapname, runtime, teleports, runtimepro, teleports_pro FROM playertimes WHERE steamid = ? AND mapname LIKE ? AND (runtime  > -1.0 OR runtimepro  > -1.0);" # STEAMID, MAPNAME
+players_jumps_query = "SELECT db1.name, db2.steamid, db2.ljrecord, db2.ljblockdist, db2.ljblockrecord, db2.bhoprecord, db2.dropbhoprecord, db2.multibhoprecord, db2.wjrecord, db2.cjrecord, db2.ladderjumprecord FROM playerjumpstats3 as db2 INNER JOIN playerrank as db1 on db2.steamid = db1.steamid WHERE db2.steamid IN ({});" # STEAMIDS
 
-player_mapranktotal_queries = {
-    "tp": "SELECT * FROM ((SELECT COUNT(*) as rank FROM playertimes WHERE runtime <= (SELECT runtime FROM playertimes WHERE steamid = ? AND mapname LIKE ? AND runtime > -1.0) AND mapname LIKE ? AND runtime > -1.0) JOIN (SELECT COUNT(*) as tot FROM playertimes WHERE mapname LIKE ? AND runtime  > -1.0));", # STEAMID, MAPNAME, MAPNAME, MAPNAME
-    "pro": "SELECT * FROM ((SELECT COUNT(*) as rank FROM playertimes WHERE runtimepro <= (SELECT runtimepro FROM playertimes WHERE steamid = ? AND mapname LIKE ? AND runtimepro > -1.0) AND mapname LIKE ? AND runtimepro > -1.0) JOIN (SELECT COUNT(*) as tot FROM playertimes WHERE mapname LIKE ? AND runtimepro  > -1.0));" # STEAMID, MAPNAME, MAPNAME, MAPNAME
-}
+compared_jumps = [("LJ", "ljrecord"), ("BlockLJ", "ljblockrecord"), ("Bhop", "bhoprecord"), ("D.-Bhop", "dropbhoprecord"), ("M.-Bhop", "multibhoprecord"), ("WJ", "wjrecord"), ("CJ", "cjrecord"), ("LAJ", "ladderjumprecord")]
+
+leaders_query = "SELECT db2.mapname, db2.runtype, db2.steamid, db2.runtime, db2.rank, db1.name FROM kz_maprank as db2 INNER JOIN playerrank as db1 on db2.steamid = db1.steamid WHERE db2.rank <= ?;" # TOP
+
+mapnames_query = "SELECT DISTINCT mapname FROM playertimes;"
+
+profile_query = "SELECT db1.name, db3.*, db2.ljblockdist, {} FROM kz_profile as db3 INNER JOIN playerrank as db1 on db1.steamid = db3.steamid LEFT JOIN playerjumpstats3 as db2 on db2.steamid = db3.steamid WHERE db3.steamid = ?;".format(", ".join("db2.{}".format(column) for name, column in compared_jumps)) # STEAMID
+profile_ranks_query = "SELECT mapname, runtype, rank, tot FROM kz_maprank WHERE steamid = ? ORDER BY rank ASC, tot DESC LIMIT ?;" # STEAMID, LIMIT
+
+player_maptime_query = "SELECT db2.name, db2.mapname, db2.runtime, db2.teleports, db2.runtimepro, db2.teleports_pro, tp.rank AS tp_rank, tp.tot AS tp_tot, pro.rank AS pro_rank, pro.tot AS pro_tot FROM playertimes as db2 LEFT JOIN kz_maprank as tp on tp.steamid = db2.steamid AND tp.mapname = db2.mapname AND tp.runtype = 'tp' LEFT JOIN kz_maprank as pro on pro.steamid = db2.steamid AND pro.mapname = db2.mapname AND pro.runtype = 'pro' WHERE db2.steamid = ? AND db2.mapname = ? AND (db2.runtime  > -1.0 OR db2.runtimepro  > -1.0);" # STEAMID, MAPNAME
 
 maptop_queries = {
-    "all": "SELECT * FROM (SELECT db1.name, db1.steamid, db2.mapname, db2.runtime as overall, db2.teleports AS tp FROM playertimes as db2 INNER JOIN playerrank as db1 on db2.steamid = db1.steamid WHERE db2.mapname LIKE ? AND db2.runtime > -1.0 AND db2.teleports >= 0 UNION SELECT db1.name, db1.steamid, db2.mapname, db2.runtimepro as overall, db2.teleports_pro AS tp FROM playertimes as db2 INNER JOIN playerrank as db1 on db2.steamid = db1.steamid WHERE db2.mapname LIKE ? AND db2.runtimepro > -1.0) GROUP BY steamid HAVING MIN(overall) ORDER BY overall ASC LIMIT ?;", # MAPNAME, MAPNAME, LIMIT
-    "tp": "SELECT db1.name, db2.mapname, db2.runtime as overall, db2.teleports AS tp FROM playertimes as db2 INNER JOIN playerrank as db1 on db2.steamid = db1.steamid WHERE db2.mapname LIKE ? AND db2.runtime > -1.0 ORDER BY db2.runtime ASC LIMIT ?;", # MAPNAME, LIMIT
-    "pro": "SELECT db1.name, db2.mapname, db2.runtimepro as overall, db2.teleports_pro as tp FROM playertimes as db2 INNER JOIN playerrank as db1 on db1.steamid = db2.steamid WHERE db2.mapname LIKE ? AND db2.runtimepro > -1.0 ORDER BY db2.runtimepro ASC LIMIT ?;" # MAPNAME, LIMIT
+    "all": "SELECT * FROM (SELECT db1.name, db1.steamid, db2.mapname, db2.runtime as overall, db2.teleports AS tp FROM playertimes as db2 INNER JOIN playerrank as db1 on db2.steamid = db1.steamid WHERE db2.mapname = ? AND db2.runtime > -1.0 AND db2.teleports >= 0 UNION SELECT db1.name, db1.steamid, db2.mapname, db2.runtimepro as overall, db2.teleports_pro AS tp FROM playertimes as db2 INNER JOIN playerrank as db1 on db2.steamid = db1.steamid WHERE db2.mapname = ? AND db2.runtimepro > -1.0) GROUP BY steamid HAVING MIN(overall) ORDER BY overall ASC LIMIT ?;", # MAPNAME, MAPNAME, LIMIT
+    "tp": "SELECT db1.name, db2.mapname, db2.runtime as overall, db2.teleports AS tp FROM playertimes as db2 INNER JOIN playerrank as db1 on db2.steamid = db1.steamid WHERE db2.mapname = ? AND db2.runtime > -1.0 ORDER BY db2.runtime ASC LIMIT ?;", # MAPNAME, LIMIT
+    "pro": "SELECT db1.name, db2.mapname, db2.runtimepro as overall, db2.teleports_pro as tp FROM playertimes as db2 INNER JOIN playerrank as db1 on db1.steamid = db2.steamid WHERE db2.mapname = ? AND db2.runtimepro > -1.0 ORDER BY db2.runtimepro ASC LIMIT ?;" # MAPNAME, LIMIT
 }
+
+maprank_select = "SELECT steamid, mapname, 'tp' AS runtype, runtime, RANK() OVER (PARTITION BY mapname ORDER BY runtime ASC) AS rank, COUNT(*) OVER (PARTITION BY mapname) AS tot FROM playertimes WHERE runtime > -1.0{0} UNION ALL SELECT steamid, mapname, 'pro' AS runtype, runtimepro AS runtime, RANK() OVER (PARTITION BY mapname ORDER BY runtimepro ASC) AS rank, COUNT(*) OVER (PARTITION BY mapname) AS tot FROM playertimes WHERE runtimepro > -1.0{0};" # EXTRA CONDITION
+
+profile_select = "SELECT p.steamid, COALESCE(m.maps, 0) AS maps, COALESCE(m.tp_maps, 0) AS tp_maps, COALESCE(m.pro_maps, 0) AS pro_maps, COALESCE(m.tp_firsts, 0) AS tp_firsts, COALESCE(m.pro_firsts, 0) AS pro_firsts, COALESCE(m.top10, 0) AS top10, m.map_percentile, {} FROM playerrank AS p LEFT JOIN (SELECT steamid, COUNT(DISTINCT mapname) AS maps, SUM(runtype = 'tp') AS tp_maps, SUM(runtype = 'pro') AS pro_maps, SUM(runtype = 'tp' AND rank = 1) AS tp_firsts, SUM(runtype = 'pro' AND rank = 1) AS pro_firsts, SUM(rank <= 10) AS top10, AVG(CASE WHEN tot > 1 THEN 100.0 * (tot - rank) / (tot - 1) ELSE 100.0 END) AS map_percentile FROM kz_maprank GROUP BY steamid) AS m ON m.steamid = p.steamid LEFT JOIN (SELECT steamid, {} FROM playerjumpstats3) AS j ON j.steamid = p.steamid;".format(
+    ", ".join("j.{}_percentile".format(column) for name, column in compared_jumps),
+    ", ".join("CASE WHEN {1} > -1.0 THEN 100.0 * PERCENT_RANK() OVER (PARTITION BY {1} > -1.0 ORDER BY {2}) END AS {0}_percentile".format(column, "ljblockdist" if column == "ljblockrecord" else column, "ljblockdist, ljblockrecord" if column == "ljblockrecord" else column) for name, column in compared_jumps))
+
+delta_keys = OrderedDict([
+    ("playerrank", ["steamid"]),
+    ("playertimes", ["steamid", "mapname"]),
+    ("playerjumpstats3", ["steamid"]),
+    ("LatestRecords", ["steamid", "map", "date"])
+])
+
+derived_statements = [
+    "CREATE INDEX IF NOT EXISTS kz_playertimes_map_runtime ON playertimes (mapname, runtime, steamid, teleports);",
+    "CREATE INDEX IF NOT EXISTS kz_playertimes_map_runtimepro ON playertimes (mapname, runtimepro, steamid, teleports_pro);",
+    "CREATE INDEX IF NOT EXISTS kz_playertimes_steamid ON playertimes (steamid);",
+    "CREATE INDEX IF NOT EXISTS kz_playerrank_steamid ON playerrank (steamid, name);",
+    "CREATE INDEX IF NOT EXISTS kz_latestrecords_map ON LatestRecords (map, teleports, runtime);",
+    "CREATE INDEX IF NOT EXISTS kz_jumpstats_ljblock ON playerjumpstats3 (ljblockdist, ljblockrecord);"
+] + ["CREATE INDEX IF NOT EXISTS kz_jumpstats_{0} ON playerjumpstats3 ({0}record);".format(j) for j in ["lj", "bhop", "multibhop", "dropbhop", "wj", "ladderjump", "cj"]] + [
+    "DROP TABLE IF EXISTS kz_maprank;",
+    "CREATE TABLE kz_maprank AS " + maprank_select.format(""),
+    "CREATE UNIQUE INDEX kz_maprank_player ON kz_maprank (steamid, mapname, runtype);",
+    "DROP TABLE IF EXISTS kz_profile;",
+    "CREATE TABLE kz_profile AS " + profile_select,
+    "CREATE UNIQUE INDEX kz_profile_steamid ON kz_profile (steamid);"
+]
@@ -4,6 +4,11 @@ from .utils.dataIO import dataIO
 from .utils import checks, chat_formatting as cf
 from __main__ import send_cmd_help
 
+import abc
+import asyncio
+import atexit
+from collections.abc import MutableMapping
+import copy
 import os
 
 default_settings = {
@@ -15,13 +20,170 @@ default_settings = {
     "channel": None
 }
 
+class LazyDocuments(MutableMapping):
+    """A dict of JSON documents that are loaded the first time they are accessed and dropped from memory again once
+    they have been idle for a while. Changes marked with save() are written together shortly after. Subclasses decide
+    how the documents are stored."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop=None, delay: float=2, idle: float=1800):
+        self.loop = loop
+        self.delay = delay
+        self.idle = idle
+        self.cache = {}
+        self.used = {}
+        self.dirty = {}
+        self.deleted = set()
+        self.handle = None
+        self.evict_handle = None
+        if self.loop is not None:
+            self.evict_handle = self.loop.call_later(self.idle, self.evict)
+        atexit.register(self.flush)
+
+    @abc.abstractmethod
+    def _load(self, key: str):
+        pass
+
+    @abc.abstractmethod
+    def _exists(self, key: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def _keys(self) -> list:
+        pass
+
+    @abc.abstractmethod
+    def _write(self, dirty: dict):
+        """Writes the documents under the keys of dirty, or removes those in self.deleted. Each value is the set of
+        entities that changed in that document, or None if all of it did."""
+
+    def _close(self):
+        pass
+
+    def __getitem__(self, key: str):
+        if key not in self.cache:
+            if key in self.deleted:
+                raise KeyError(key)
+            self.cache[key] = self._load(key)
+        if self.loop is not None:
+            self.used[key] = self.loop.time()
+        return self.cache[key]
+
+    def __setitem__(self, key: str, value):
+        self.cache[key] = value
+        self.deleted.discard(key)
+        if self.loop is not None:
+            self.used[key] = self.loop.time()
+        self._mark(key, None)
+
+    def __delitem__(self, key: str):
+        self[key]
+        del self.cache[key]
+        self.used.pop(key, None)
+        self.deleted.add(key)
+        self._mark(key, None)
+
+    def __contains__(self, key: str) -> bool:
+        if key in self.cache:
+            return True
+        if key in self.deleted:
+            return False
+        return self._exists(key)
+
+    def __iter__(self):
+        stored = self._keys()
+        stored_keys = set(stored)
+        keys = stored + [k for k in self.cache if k not in stored_keys]
+        return iter([k for k in keys if k not in self.deleted])
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+    def save(self, key: str, *entities: str):
+        """Marks the document under key as changed, after mutating it in place. If entities are given, only those
+        entities of the document are rewritten, where the store keeps them apart. The document must still be loaded;
+        look it up again rather than keeping a reference to it across an await."""
+
+        if key not in self.cache and key not in self.deleted:
+            raise RuntimeError("'{}' was saved after it had been dropped from memory, so the change would be lost.".format(key))
+        self._mark(key, set(entities) if entities else None)
+
+    def _mark(self, key: str, entities: set):
+        if entities is None or key in self.dirty and self.dirty[key] is None:
+            self.dirty[key] = None
+        else:
+            self.dirty[key] = self.dirty.get(key, set()) | entities
+
+        if self.loop is None:
+            self.flush()
+        elif self.handle is None:
+            self.handle = self.loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if not self.dirty:
+            return
+
+        self._write(self.dirty)
+        self.dirty.clear()
+        self.deleted.clear()
+
+    def evict(self):
+        """Drops documents that have not been accessed for the idle time from memory. Unsaved documents are kept."""
+
+        now = self.loop.time()
+        for key, used in list(self.used.items()):
+            if now - used >= self.idle and key not in self.dirty:
+                del self.cache[key]
+                del self.used[key]
+        self.evict_handle = self.loop.call_later(self.idle, self.evict)
+
+    def close(self):
+        if self.evict_handle is not None:
+            self.evict_handle.cancel()
+        self.flush()
+        atexit.unregister(self.flush)
+        self._close()
+
+class JsonShards(LazyDocuments):
+    """Stores documents in a directory, one JSON file per document, so that a change only rewrites its own file."""
+
+    def __init__(self, path: str, loop: asyncio.AbstractEventLoop=None, delay: float=2, idle: float=1800):
+        super().__init__(loop, delay, idle)
+        self.path = path
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, "{}.json".format(key))
+
+    def _load(self, key: str):
+        if not os.path.exists(self._file(key)):
+            raise KeyError(key)
+        return dataIO.load_json(self._file(key))
+
+    def _exists(self, key: str) -> bool:
+        return os.path.exists(self._file(key))
+
+    def _keys(self) -> list:
+        return [f[:-len(".json")] for f in os.listdir(self.path) if f.endswith(".json")]
+
+    def _write(self, dirty: dict):
+        for key in dirty:
+            if key not in self.deleted:
+                dataIO.save_json(self._file(key), self.cache[key])
+            elif os.path.exists(self._file(key)):
+                os.remove(self._file(key))
+
 class Membership:
     """Announces membership events on the server."""
 
     def __init__(self, bot: commands.bot.Bot):
         self.bot = bot
-        self.settings_path = "data/membership/settings.json"
-        self.settings = dataIO.load_json(self.settings_path)
+        self.settings_path = "data/membership/servers"
+        self.settings = JsonShards(self.settings_path, self.bot.loop)
+
+    def __unload(self):
+        self.settings.close()
 
     @commands.group(pass_context=True, no_pm=True, name="membershipset")
     @checks.admin_or_permissions(manage_server=True)
@@ -29,9 +191,9 @@ class Membership:
         """Sets membership settings."""
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
+            self.settings[server.id] = copy.deepcopy(default_settings)
             self.settings[server.id]["channel"] = server.default_channel.id
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings.save(server.id)
         if context.invoked_subcommand is None:
             await send_cmd_help(context)
 
@@ -45,7 +207,7 @@ class Membership:
         await self.bot.type()
         server = context.message.server
         self.settings[server.id]["join_message"] = format_str
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings.save(server.id)
         await self.bot.reply(cf.info("Join message set."))
 
     @_membershipset.command(pass_context=True, no_pm=True, name="leave", aliases=["farewell"])
@@ -58,7 +220,7 @@ class Membership:
         await self.bot.type()
         server = context.message.server
         self.settings[server.id]["leave_message"] = format_str
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings.save(server.id)
         await self.bot.reply(cf.info("Leave message set."))
 
     @_membershipset.command(pass_context=True, no_pm=True, name="ban")
@@ -71,7 +233,7 @@ class Membership:
         await self.bot.type()
         server = context.message.server
         self.settings[server.id]["ban_message"] = format_str
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings.save(server.id)
         await self.bot.reply(cf.info("Ban message set."))
 
     @_membershipset.command(pass_context=True, no_pm=True, name="unban")
@@ -84,7 +246,7 @@ class Membership:
         await self.bot.type()
         server = context.message.server
         self.settings[server.id]["unban_message"] = format_str
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings.save(server.id)
         await self.bot.reply(cf.info("Unban message set."))
 
     @_membershipset.command(pass_context=True, no_pm=True, name="toggle")
@@ -98,7 +260,7 @@ class Membership:
             await self.bot.reply(cf.info("Membership events will now be announced."))
         else:
             await self.bot.reply(cf.info("Membership events will no longer be announced."))
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings.save(server.id)
 
     @_membershipset.command(pass_context=True, no_pm=True, name="channel")
     async def _channel(self, context: commands.context.Context, channel: discord.Channel=None):
@@ -114,7 +276,7 @@ class Membership:
             await self.bot.reply("I don't have permission to send messages in {0.mention}.".format(channel))
             return
         self.settings[server.id]["channel"] = channel.id
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings.save(server.id)
         channel = self.get_welcome_channel(server)
         await self.bot.send_message(channel, ("{0.mention}, " + cf.info("I will now send membership announcements to {1.mention}.")).format(context.message.author, channel))
 
@@ -123,9 +285,9 @@ class Membership:
 
         server = member.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
+            self.settings[server.id] = copy.deepcopy(default_settings)
             self.settings[server.id]["channel"] = server.default_channel.id
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings.save(server.id)
 
         if not self.settings[server.id]["on"]:
             return
@@ -145,9 +307,9 @@ class Membership:
 
         server = member.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
+            self.settings[server.id] = copy.deepcopy(default_settings)
             self.settings[server.id]["channel"] = server.default_channel.id
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings.save(server.id)
 
         if not self.settings[server.id]["on"]:
             return
@@ -167,9 +329,9 @@ class Membership:
 
         server = member.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
+            self.settings[server.id] = copy.deepcopy(default_settings)
             self.settings[server.id]["channel"] = server.default_channel.id
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings.save(server.id)
 
         if not self.settings[server.id]["on"]:
             return
@@ -189,9 +351,9 @@ class Membership:
 
         server = member.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
+            self.settings[server.id] = copy.deepcopy(default_settings)
             self.settings[server.id]["channel"] = server.default_channel.id
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings.save(server.id)
 
         if not self.settings[server.id]["on"]:
             return
@@ -220,10 +382,16 @@ def check_folders():
         os.makedirs("data/membership")
 
 def check_files():
-    f = "data/membership/settings.json"
-    if not dataIO.is_valid_json(f):
-        print("Creating data/membership/settings.json...")
-        dataIO.save_json(f, {})
+    f = "data/membership/servers"
+    if not os.path.exists(f):
+        print("Creating data/membership/servers directory...")
+        os.makedirs(f)
+        old = "data/membership/settings.json"
+        if dataIO.is_valid_json(old):
+            print("Splitting data/membership/settings.json into data/membership/servers...")
+            settings = JsonShards(f)
+            settings.update(dataIO.load_json(old))
+            settings.close()
 
 def setup(bot: commands.bot.Bot):
     check_folders()
@@ -6,21 +6,216 @@ from __main__ import send_cmd_help
 
 from typing import List
 
+import abc
+import asyncio
+import atexit
+import copy
+from collections.abc import MutableMapping
+import json
 import os
 import random
+import sqlite3
 
 default_settings = {
     "next_index": 1,
     "quotes": {}
 }
 
+class LazyDocuments(MutableMapping):
+    """A dict of JSON documents that are loaded the first time they are accessed and dropped from memory again once
+    they have been idle for a while. Changes marked with save() are written together shortly after. Subclasses decide
+    how the documents are stored."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop=None, delay: float=2, idle: float=1800):
+        self.loop = loop
+        self.delay = delay
+        self.idle = idle
+        self.cache = {}
+        self.used = {}
+        self.dirty = {}
+        self.deleted = set()
+        self.handle = None
+        self.evict_handle = None
+        if self.loop is not None:
+            self.evict_handle = self.loop.call_later(self.idle, self.evict)
+        atexit.register(self.flush)
+
+    @abc.abstractmethod
+    def _load(self, key: str):
+        pass
+
+    @abc.abstractmethod
+    def _exists(self, key: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def _keys(self) -> list:
+        pass
+
+    @abc.abstractmethod
+    def _write(self, dirty: dict):
+        """Writes the documents under the keys of dirty, or removes those in self.deleted. Each value is the set of
+        entities that changed in that document, or None if all of it did."""
+
+    def _close(self):
+        pass
+
+    def __getitem__(self, key: str):
+        if key not in self.cache:
+            if key in self.deleted:
+                raise KeyError(key)
+            self.cache[key] = self._load(key)
+        if self.loop is not None:
+            self.used[key] = self.loop.time()
+        return self.cache[key]
+
+    def __setitem__(self, key: str, value):
+        self.cache[key] = value
+        self.deleted.discard(key)
+        if self.loop is not None:
+            self.used[key] = self.loop.time()
+        self._mark(key, None)
+
+    def __delitem__(self, key: str):
+        self[key]
+        del self.cache[key]
+        self.used.pop(key, None)
+        self.deleted.add(key)
+        self._mark(key, None)
+
+    def __contains__(self, key: str) -> bool:
+        if key in self.cache:
+            return True
+        if key in self.deleted:
+            return False
+        return self._exists(key)
+
+    def __iter__(self):
+        stored = self._keys()
+        stored_keys = set(stored)
+        keys = stored + [k for k in self.cache if k not in stored_keys]
+        return iter([k for k in keys if k not in self.deleted])
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+    def save(self, key: str, *entities: str):
+        """Marks the document under key as changed, after mutating it in place. If entities are given, only those
+        entities of the document are rewritten, where the store keeps them apart. The document must still be loaded;
+        look it up again rather than keeping a reference to it across an await."""
+
+        if key not in self.cache and key not in self.deleted:
+            raise RuntimeError("'{}' was saved after it had been dropped from memory, so the change would be lost.".format(key))
+        self._mark(key, set(entities) if entities else None)
+
+    def _mark(self, key: str, entities: set):
+        if entities is None or key in self.dirty and self.dirty[key] is None:
+            self.dirty[key] = None
+        else:
+            self.dirty[key] = self.dirty.get(key, set()) | entities
+
+        if self.loop is None:
+            self.flush()
+        elif self.handle is None:
+            self.handle = self.loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if not self.dirty:
+            return
+
+        self._write(self.dirty)
+        self.dirty.clear()
+        self.deleted.clear()
+
+    def evict(self):
+        """Drops documents that have not been accessed for the idle time from memory. Unsaved documents are kept."""
+
+        now = self.loop.time()
+        for key, used in list(self.used.items()):
+            if now - used >= self.idle and key not in self.dirty:
+                del self.cache[key]
+                del self.used[key]
+        self.evict_handle = self.loop.call_later(self.idle, self.evict)
+
+    def close(self):
+        if self.evict_handle is not None:
+            self.evict_handle.cancel()
+        self.flush()
+        atexit.unregister(self.flush)
+        self._close()
+
+class SqliteDict(LazyDocuments):
+    """Stores documents in a SQLite database in WAL mode, with one row per entity, so that changing an entity only
+    rewrites its own row. The entities of a document are the items of its collection key, or of the document itself
+    if no collection is given; the rest of the document is kept in one more row."""
+
+    def __init__(self, path: str, loop: asyncio.AbstractEventLoop=None, collection: str=None, delay: float=2, idle: float=1800):
+        super().__init__(loop, delay, idle)
+        self.collection = collection
+        self.con = sqlite3.connect(path)
+        self.con.execute("PRAGMA journal_mode = WAL")
+        self.con.execute("PRAGMA synchronous = NORMAL")
+        self.con.execute("CREATE TABLE IF NOT EXISTS entities (key TEXT NOT NULL, entity TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (key, entity));")
+
+    def _split(self, document) -> tuple:
+        if not isinstance(document, dict):
+            return document, {}
+        if self.collection is None:
+            return {}, document
+        rest = dict(document)
+        return rest, rest.pop(self.collection, {})
+
+    def _load(self, key: str):
+        values = {e: json.loads(v) for e, v in self.con.execute("SELECT entity, value FROM entities WHERE key = ?;", (key,))}
+        if "" not in values:
+            raise KeyError(key)
+        rest = values.pop("")
+        if self.collection is not None:
+            rest[self.collection] = values
+        elif isinstance(rest, dict):
+            rest.update(values)
+        return rest
+
+    def _exists(self, key: str) -> bool:
+        return self.con.execute("SELECT 1 FROM entities WHERE key = ? AND entity = '';", (key,)).fetchone() is not None
+
+    def _keys(self) -> list:
+        return [r[0] for r in self.con.execute("SELECT key FROM entities WHERE entity = '';")]
+
+    def _write(self, dirty: dict):
+        with self.con:
+            for key, entities in dirty.items():
+                if key in self.deleted or entities is None:
+                    self.con.execute("DELETE FROM entities WHERE key = ?;", (key,))
+                if key in self.deleted:
+                    continue
+
+                rest, items = self._split(self.cache[key])
+                if entities is None:
+                    entities = items.keys()
+                self.con.execute("INSERT OR REPLACE INTO entities (key, entity, value) VALUES (?, '', ?);", (key, json.dumps(rest)))
+                for entity in entities:
+                    if entity in items:
+                        self.con.execute("INSERT OR REPLACE INTO entities (key, entity, value) VALUES (?, ?, ?);", (key, entity, json.dumps(items[entity])))
+                    else:
+                        self.con.execute("DELETE FROM entities WHERE key = ? AND entity = ?;", (key, entity))
+
+    def _close(self):
+        self.con.close()
+
 class Quotes:
     """Stores and shows quotes."""
 
     def __init__(self, bot: commands.bot.Bot):
         self.bot = bot
-        self.settings_path = "data/quotes/settings.json"
-        self.settings = dataIO.load_json(self.settings_path)
+        self.settings_path = "data/quotes/settings.sq3"
+        self.settings = SqliteDict(self.settings_path, self.bot.loop, collection="quotes")
+
+    def __unload(self):
+        self.settings.close()
 
     def list_quotes(self, server: discord.Server) -> List[str]:
         tups = [(int(k), v) for (k,v) in self.settings[server.id]["quotes"].items()]
@@ -34,13 +229,13 @@ class Quotes:
         await self.bot.type()
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings.save(server.id)
 
         idx = self.settings[server.id]["next_index"]
         self.settings[server.id]["quotes"][str(idx)] = new_quote
         self.settings[server.id]["next_index"] += 1
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings.save(server.id, str(idx))
 
         await self.bot.reply(cf.info("Quote added as number {}.".format(idx)))
 
@@ -51,7 +246,7 @@ class Quotes:
         await self.bot.type()
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
+            self.settings[server.id] = copy.deepcopy(default_settings)
 
         try:
             int(number)
@@ -64,7 +259,7 @@ class Quotes:
             await self.bot.reply(cf.error("A quote with that number cannot be found. Try `{}allquotes` for a list.".format(context.prefix)))
             return
 
-        dataIO.save_json(self.settings_path, self.settings)
+        self.settings.save(server.id, number)
 
         await self.bot.reply(cf.info("Quote number {} deleted.".format(number)))
 
@@ -76,8 +271,8 @@ class Quotes:
         server = context.message.server
 
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings.save(server.id)
 
         if len(self.settings[server.id]["quotes"]) == 0:
             await self.bot.reply(cf.warning("There are no saved quotes. Use `{}addquote` to add one.".format(context.prefix)))
@@ -105,8 +300,8 @@ class Quotes:
         await self.bot.type()
         server = context.message.server
         if server.id not in self.settings:
-            self.settings[server.id] = default_settings
-            dataIO.save_json(self.settings_path, self.settings)
+            self.settings[server.id] = copy.deepcopy(default_settings)
+            self.settings.save(server.id)
 
         if len(self.settings[server.id]["quotes"]) == 0:
             await self.bot.reply(cf.warning("There are no saved quotes. Use `{}addquote` to add one.".format(context.prefix)))
@@ -134,10 +329,17 @@ def check_folders():
         os.makedirs("data/quotes")
 
 def check_files():
-    f = "data/quotes/settings.json"
-    if not dataIO.is_valid_json(f):
-        print("Creating data/quotes/settings.json...")
-        dataIO.save_json(f, {})
+    f = "data/quotes/settings.sq3"
+    if not os.path.exists(f):
+        old = "data/quotes/settings.json"
+        documents = SqliteDict(f, collection="quotes")
+        if dataIO.is_valid_json(old):
+            print("Importing data/quotes/settings.json into data/quotes/settings.sq3...")
+            documents.update(dataIO.load_json(old))
+        else:
+            print("Creating data/quotes/settings.sq3...")
+            documents.update({})
+        documents.close()
 
 def setup(bot: commands.bot.Bot):
     check_folders()
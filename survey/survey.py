@@ -5,29 +5,222 @@ from .utils import checks, chat_formatting as cf
 
 from typing import Any, Dict, List
 
+import abc
 import asyncio
+import atexit
 from collections import defaultdict
+from collections.abc import MutableMapping
 from datetime import datetime
 from dateutil import parser as dp
 from itertools import zip_longest
+import json
 import os
 import pytz
+import sqlite3
 from tabulate import tabulate
 
 Option = Dict[str, Any]
 Options = Dict[str, Option]
 
+class LazyDocuments(MutableMapping):
+    """A dict of JSON documents that are loaded the first time they are accessed and dropped from memory again once
+    they have been idle for a while. Changes marked with save() are written together shortly after. Subclasses decide
+    how the documents are stored."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop=None, delay: float=2, idle: float=1800):
+        self.loop = loop
+        self.delay = delay
+        self.idle = idle
+        self.cache = {}
+        self.used = {}
+        self.dirty = {}
+        self.deleted = set()
+        self.handle = None
+        self.evict_handle = None
+        if self.loop is not None:
+            self.evict_handle = self.loop.call_later(self.idle, self.evict)
+        atexit.register(self.flush)
+
+    @abc.abstractmethod
+    def _load(self, key: str):
+        pass
+
+    @abc.abstractmethod
+    def _exists(self, key: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def _keys(self) -> list:
+        pass
+
+    @abc.abstractmethod
+    def _write(self, dirty: dict):
+        """Writes the documents under the keys of dirty, or removes those in self.deleted. Each value is the set of
+        entities that changed in that document, or None if all of it did."""
+
+    def _close(self):
+        pass
+
+    def __getitem__(self, key: str):
+        if key not in self.cache:
+            if key in self.deleted:
+                raise KeyError(key)
+            self.cache[key] = self._load(key)
+        if self.loop is not None:
+            self.used[key] = self.loop.time()
+        return self.cache[key]
+
+    def __setitem__(self, key: str, value):
+        self.cache[key] = value
+        self.deleted.discard(key)
+        if self.loop is not None:
+            self.used[key] = self.loop.time()
+        self._mark(key, None)
+
+    def __delitem__(self, key: str):
+        self[key]
+        del self.cache[key]
+        self.used.pop(key, None)
+        self.deleted.add(key)
+        self._mark(key, None)
+
+    def __contains__(self, key: str) -> bool:
+        if key in self.cache:
+            return True
+        if key in self.deleted:
+            return False
+        return self._exists(key)
+
+    def __iter__(self):
+        stored = self._keys()
+        stored_keys = set(stored)
+        keys = stored + [k for k in self.cache if k not in stored_keys]
+        return iter([k for k in keys if k not in self.deleted])
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+    def save(self, key: str, *entities: str):
+        """Marks the document under key as changed, after mutating it in place. If entities are given, only those
+        entities of the document are rewritten, where the store keeps them apart. The document must still be loaded;
+        look it up again rather than keeping a reference to it across an await."""
+
+        if key not in self.cache and key not in self.deleted:
+            raise RuntimeError("'{}' was saved after it had been dropped from memory, so the change would be lost.".format(key))
+        self._mark(key, set(entities) if entities else None)
+
+    def _mark(self, key: str, entities: set):
+        if entities is None or key in self.dirty and self.dirty[key] is None:
+            self.dirty[key] = None
+        else:
+            self.dirty[key] = self.dirty.get(key, set()) | entities
+
+        if self.loop is None:
+            self.flush()
+        elif self.handle is None:
+            self.handle = self.loop.call_later(self.delay, self.flush)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if not self.dirty:
+            return
+
+        self._write(self.dirty)
+        self.dirty.clear()
+        self.deleted.clear()
+
+    def evict(self):
+        """Drops documents that have not been accessed for the idle time from memory. Unsaved documents are kept."""
+
+        now = self.loop.time()
+        for key, used in list(self.used.items()):
+            if now - used >= self.idle and key not in self.dirty:
+                del self.cache[key]
+                del self.used[key]
+        self.evict_handle = self.loop.call_later(self.idle, self.evict)
+
+    def close(self):
+        if self.evict_handle is not None:
+            self.evict_handle.cancel()
+        self.flush()
+        atexit.unregister(self.flush)
+        self._close()
+
+class SqliteDict(LazyDocuments):
+    """Stores documents in a SQLite database in WAL mode, with one row per entity, so that changing an entity only
+    rewrites its own row. The entities of a document are the items of its collection key, or of the document itself
+    if no collection is given; the rest of the document is kept in one more row."""
+
+    def __init__(self, path: str, loop: asyncio.AbstractEventLoop=None, collection: str=None, delay: float=2, idle: float=1800):
+        super().__init__(loop, delay, idle)
+        self.collection = collection
+        self.con = sqlite3.connect(path)
+        self.con.execute("PRAGMA journal_mode = WAL")
+        self.con.execute("PRAGMA synchronous = NORMAL")
+        self.con.execute("CREATE TABLE IF NOT EXISTS entities (key TEXT NOT NULL, entity TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (key, entity));")
+
+    def _split(self, document) -> tuple:
+        if not isinstance(document, dict):
+            return document, {}
+        if self.collection is None:
+            return {}, document
+        rest = dict(document)
+        return rest, rest.pop(self.collection, {})
+
+    def _load(self, key: str):
+        values = {e: json.loads(v) for e, v in self.con.execute("SELECT entity, value FROM entities WHERE key = ?;", (key,))}
+        if "" not in values:
+            raise KeyError(key)
+        rest = values.pop("")
+        if self.collection is not None:
+            rest[self.collection] = values
+        elif isinstance(rest, dict):
+            rest.update(values)
+        return rest
+
+    def _exists(self, key: str) -> bool:
+        return self.con.execute("SELECT 1 FROM entities WHERE key = ? AND entity = '';", (key,)).fetchone() is not None
+
+    def _keys(self) -> list:
+        return [r[0] for r in self.con.execute("SELECT key FROM entities WHERE entity = '';")]
+
+    def _write(self, dirty: dict):
+        with self.con:
+            for key, entities in dirty.items():
+                if key in self.deleted or entities is None:
+                    self.con.execute("DELETE FROM entities WHERE key = ?;", (key,))
+                if key in self.deleted:
+                    continue
+
+                rest, items = self._split(self.cache[key])
+                if entities is None:
+                    entities = items.keys()
+                self.con.execute("INSERT OR REPLACE INTO entities (key, entity, value) VALUES (?, '', ?);", (key, json.dumps(rest)))
+                for entity in entities:
+                    if entity in items:
+                        self.con.execute("INSERT OR REPLACE INTO entities (key, entity, value) VALUES (?, ?, ?);", (key, entity, json.dumps(items[entity])))
+                    else:
+                        self.con.execute("DELETE FROM entities WHERE key = ? AND entity = ?;", (key, entity))
+
+    def _close(self):
+        self.con.close()
+
 class Survey:
     """Runs surveys for a specific role of people via DM, and prints real-time results to a given text channel.
     Supports changing responses, answer option quotas, and reminders based on initial answer."""
     def __init__(self, bot: commands.bot.Bot):
         self.bot = bot
-        self.surveys_path = "data/survey/surveys.json"
-        self.surveys = dataIO.load_json(self.surveys_path)
+        self.surveys_path = "data/survey/surveys.sq3"
+        self.surveys = SqliteDict(self.surveys_path, self.bot.loop)
         self.tasks = defaultdict(list)
         
         self.bot.loop.create_task(self._resume_running_surveys())
 
+    def __unload(self):
+        self.surveys.close()
+
     async def _resume_running_surveys(self):
         await self.bot.wait_until_ready()
 
@@ -74,7 +267,7 @@ class Survey:
         if survey_id not in closed:
             closed.append(survey_id)
 
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save("closed")
 
     async def _parse_options(self, options: str) -> Options:
         opts_list = None if options == "*" else [r.lower().strip() for r in options.split(";")]
@@ -131,34 +324,34 @@ class Survey:
 
     def _save_deadline(self, server_id: str, survey_id: str, deadline: str):
         self.surveys[server_id][survey_id]["deadline"] = deadline
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save(server_id, survey_id)
 
     def _save_channel(self, server_id: str, survey_id: str, channel_id: str):
         self.surveys[server_id][survey_id]["channel"] = channel_id
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save(server_id, survey_id)
 
     def _save_question(self, server_id: str, survey_id: str, question: str):
         self.surveys[server_id][survey_id]["question"] = question
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save(server_id, survey_id)
 
     def _save_options(self, server_id: str, survey_id: str, options: Options):
         self.surveys[server_id][survey_id]["options"] = options
         self.surveys[server_id][survey_id]["answers"] = {}
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save(server_id, survey_id)
 
         if options != "any":
             for opt in options:
                 self.surveys[server_id][survey_id]["answers"][opt] = []
-                dataIO.save_json(self.surveys_path, self.surveys)
+                self.surveys.save(server_id, survey_id)
 
     def _save_asked(self, server_id: str, survey_id: str, users: List[discord.User]):
         asked = [u.id for u in users]
         self.surveys[server_id][survey_id]["asked"] = asked
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save(server_id, survey_id)
 
     def _save_prefix(self, server_id: str, survey_id: str, prefix: str):
         self.surveys[server_id][survey_id]["prefix"] = prefix
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save(server_id, survey_id)
 
     def _save_answer(self, server_id: str, survey_id: str, user: discord.User, answer: str, change: bool) -> bool:
         answers = self.surveys[server_id][survey_id]["answers"]
@@ -180,7 +373,7 @@ class Survey:
         answers[answer].append(user.id)
         if user.id in asked:
             asked.remove(user.id)
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save(server_id, survey_id)
         return True
 
     def _setup_reprompts(self, server_id: str, survey_id: str):
@@ -226,7 +419,7 @@ class Survey:
                 wait_message = await self.bot.send_message(channel, "{}\n{}".format("Awaiting answers from:", cf.box(waiting))) 
                 self.surveys[server_id][survey_id]["messages"]["waiting"] = wait_message.id
 
-            dataIO.save_json(self.surveys_path, self.surveys)
+            self.surveys.save(server_id, survey_id)
         else:
             res_message = await self.bot.edit_message(await self.bot.get_message(channel, self.surveys[server_id][survey_id]["messages"]["results"]), "{} (ID {})\n{}".format(cf.bold(question), survey_id, cf.box(table)))
             self.surveys[server_id][survey_id]["messages"]["results"] = res_message.id
@@ -237,7 +430,7 @@ class Survey:
                 await self.bot.delete_message(await self.bot.get_message(channel, self.surveys[server_id][survey_id]["messages"]["waiting"]))
                 self.surveys[server_id][survey_id]["messages"]["waiting"] = None
 
-            dataIO.save_json(self.surveys_path, self.surveys)
+            self.surveys.save(server_id, survey_id)
 
     def _make_answer_table(self, server_id: str, survey_id: str) -> str:
         server = self.bot.get_server(server_id)
@@ -328,7 +521,7 @@ class Survey:
 
         if server.id not in self.surveys:
             self.surveys[server.id] = {}
-            dataIO.save_json(self.surveys_path, self.surveys)
+            self.surveys.save(server.id)
 
         dl = None
         try:
@@ -343,10 +536,10 @@ class Survey:
 
         new_survey_id = str(self.surveys["next_id"])
         self.surveys["next_id"] += 1
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save("next_id")
 
         self.surveys[server.id][new_survey_id] = {}
-        dataIO.save_json(self.surveys_path, self.surveys)
+        self.surveys.save(server.id, new_survey_id)
 
         self._save_prefix(server.id, new_survey_id, context.prefix)
         self._save_deadline(server.id, new_survey_id, deadline)
@@ -417,10 +610,17 @@ def check_folders():
         os.makedirs("data/survey")
 
 def check_files():
-    f = "data/survey/surveys.json"
-    if not dataIO.is_valid_json(f):
-        print("Creating data/survey/surveys.json...")
-        dataIO.save_json(f, {"next_id": 1, "closed": []})
+    f = "data/survey/surveys.sq3"
+    if not os.path.exists(f):
+        old = "data/survey/surveys.json"
+        documents = SqliteDict(f)
+        if dataIO.is_valid_json(old):
+            print("Importing data/survey/surveys.json into data/survey/surveys.sq3...")
+            documents.update(dataIO.load_json(old))
+        else:
+            print("Creating data/survey/surveys.sq3...")
+            documents.update({"next_id": 1, "closed": []})
+        documents.close()
 
 def setup(bot: commands.bot.Bot):
     check_folders()